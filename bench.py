@@ -0,0 +1,416 @@
+"""Офлайн-бенчмарк bot.py: без токена Telegram и без GPU.
+
+Гоняет настоящие хендлеры (handle_message, reset, delete_chat, переключение
+чатов) на синтетических Update через фейковый Bot, который только
+записывает вызовы Bot API, и локальную aiohttp-заглушку LM Studio с
+настраиваемой задержкой и стримингом.
+
+    python bench.py load --users 1000 --messages 3
+    python bench.py load --users 10000 --lm-ttft 0.2 --no-stream
+    python bench.py micro
+    python bench.py cluster --workers 4 --users 2000
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import ApplicationBuilder, ExtBot
+
+import bot
+
+
+# ======== ФЕЙКОВЫЙ TELEGRAM ========
+
+class RecordingBot(ExtBot):
+    """Bot, который никуда не ходит: отвечает на вызовы Bot API правдоподобными
+    объектами и считает их (calls) с необязательной задержкой."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(token="0:bench")
+        with self._unfrozen():  # объекты PTB после __init__ заморожены
+            self.latency = latency
+            self.calls: Counter = Counter()
+            self._message_ids = itertools.count(1_000_000)
+
+    async def _do_post(self, endpoint: str, data: dict, *args, **kwargs):
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if endpoint in ("sendMessage", "editMessageText"):
+            return {
+                "message_id": data.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": data["chat_id"], "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+
+_update_ids = itertools.count(1)
+_user_message_ids = itertools.count(1)
+
+def make_update(tg_bot: ExtBot, user_id: int, text: str) -> Update:
+    message = {
+        "message_id": next(_user_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": next(_update_ids), "message": message}, tg_bot)
+
+
+def make_tg_stub(updates: List[dict], calls: Counter, state: dict) -> web.Application:
+    """Фейковый HTTP Bot API для многопроцессного режима: отдаёт заранее
+    подготовленные апдейты через getUpdates и правдоподобно отвечает на
+    остальные методы. state["offset"] — подтверждённый фронтом offset."""
+    message_ids = itertools.count(1_000_000)
+
+    async def params(request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        out = {}
+        for k, v in (await request.post()).items():
+            try:
+                out[k] = json.loads(v)
+            except (TypeError, ValueError):
+                out[k] = v
+        return out
+
+    async def method(request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        data = await params(request)
+        calls[name] += 1
+        result: object = True
+        if name == "getUpdates":
+            state["offset"] = offset = int(data.get("offset") or 0)
+            result = [u for u in updates[offset - 1 if offset else 0:][:100]]
+            if not result and data.get("timeout"):
+                await asyncio.sleep(0.2)
+        elif name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif name in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": data.get("message_id") or next(message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(data["chat_id"]), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", method)
+    return app
+
+
+# ======== ЗАГЛУШКА LM STUDIO ========
+
+STUB_REPLY = "Привет! Это тестовый ответ заглушки. Он нужен только для замеров. "
+
+def make_lm_stub(ttft: float, token_delay: float, tokens: int) -> web.Application:
+    words = (STUB_REPLY * (tokens // 8 + 1)).split(" ")[:tokens]
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        await asyncio.sleep(ttft)
+        if not payload.get("stream"):
+            if token_delay:
+                await asyncio.sleep(token_delay * len(words))
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for i, w in enumerate(words):
+            chunk = {"choices": [{"delta": {"content": w if i == 0 else " " + w}}]}
+            await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            if token_delay:
+                await asyncio.sleep(token_delay)
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def models(request: web.Request) -> web.Response:
+        return web.json_response({"data": [{"id": "stub"}]})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    app.router.add_get("/v1/models", models)
+    return app
+
+
+# ======== НАГРУЗКА ========
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def run_load(args) -> None:
+    bot.LM_STREAM = args.stream
+    if args.edit_interval is not None:
+        bot.STREAM_EDIT_INTERVAL = args.edit_interval
+    bot.DELETE_IN_BACKGROUND = False  # удаление входит в замер хендлера
+    bot.CACHE_ENABLED = args.cache
+
+    runner = web.AppRunner(make_lm_stub(args.lm_ttft, args.lm_token_delay, args.lm_tokens), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/v1/chat/completions"
+
+    tg_bot = RecordingBot(latency=args.tg_latency)
+    app = ApplicationBuilder().bot(tg_bot).updater(None) \
+        .concurrent_updates(bot.PerUserUpdateProcessor(bot.MAX_CONCURRENT_UPDATES)).build()
+    bot.setup_application(app)
+    app.bot_data["lm_router"] = bot.ModelRouter([{
+        "name": "stub",
+        "backends": [{"url": url, "model": "stub"}],
+        "max_concurrent": args.lm_concurrency,
+        "max_queue": args.users * args.messages,
+    }])
+    await app.initialize()
+    await app.start()
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+
+    async def send(user_id: int, text: str, kind: str) -> None:
+        update = make_update(tg_bot, user_id, text)
+        t0 = time.perf_counter()
+        await app.update_processor.process_update(update, app.process_update(update))
+        latencies[kind].append(time.perf_counter() - t0)
+
+    async def scenario(user_id: int) -> None:
+        await send(user_id, "/start", "start")
+        for i in range(args.messages):
+            await send(user_id, f"Вопрос номер {i}: как дела?", "message")
+        await send(user_id, bot.BTN_NEW_CHAT, "new_chat")
+        await send(user_id, "Ещё вопрос в новом чате", "message")
+        await send(user_id, "чат 1", "switch")
+        await send(user_id, "/reset", "reset")
+        await send(user_id, "/deletechat yes", "delete_chat")
+
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id: int) -> None:
+        async with sem:
+            await scenario(user_id)
+
+    gc.collect()
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(limited(uid) for uid in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    mem_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    await app.stop()
+    await app.shutdown()
+    session_http = app.bot_data.get("lm_session")
+    if session_http is not None:
+        await session_http.close()
+    await runner.cleanup()
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"пользователей: {args.users}, апдейтов: {total}, время: {elapsed:.2f} с")
+    print(f"апдейтов/с: {total / elapsed:.1f}, сообщений к модели/с: {len(latencies['message']) / elapsed:.1f}")
+    print(f"память на пользователя: {(mem_after - mem_before) / args.users / 1024:.1f} КиБ")
+    print(f"{'хендлер':<12} {'n':>7} {'p50, мс':>9} {'p99, мс':>9} {'сред., мс':>10}")
+    for kind, values in sorted(latencies.items()):
+        print(f"{kind:<12} {len(values):>7} {percentile(values, 50) * 1000:>9.1f} "
+              f"{percentile(values, 99) * 1000:>9.1f} {statistics.fmean(values) * 1000:>10.1f}")
+    print("вызовы Bot API:", dict(tg_bot.calls.most_common()))
+
+
+async def start_site(app: web.Application) -> Tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+async def run_cluster(args) -> None:
+    """Фронт и воркеры настоящими процессами; Telegram и LM Studio — заглушки."""
+    texts = ["/start"] + [f"Вопрос номер {i}: как дела?" for i in range(args.messages)]
+    updates = []
+    for i, text in enumerate(texts):
+        for user_id in range(1, args.users + 1):
+            updates.append(json.loads(make_update(None, user_id, text).to_json()))
+    for n, u in enumerate(updates, 1):
+        u["update_id"] = n
+
+    calls: Counter = Counter()
+    state = {"offset": 0}
+    tg_runner, tg_port = await start_site(make_tg_stub(updates, calls, state))
+    lm_runner, lm_port = await start_site(make_lm_stub(args.lm_ttft, args.lm_token_delay, args.lm_tokens))
+    db_dir = tempfile.mkdtemp(prefix="bench-cluster-")
+    overrides = {
+        "TELEGRAM_BOT_TOKEN": "0:bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_port}",
+        "LM_BACKENDS": [{"url": f"http://127.0.0.1:{lm_port}/v1/chat/completions", "model": "stub"}],
+        "LM_MAX_CONCURRENT": args.lm_concurrency,
+        "LM_QUEUE_LIMIT": args.users * args.messages,
+        "LM_STREAM": args.stream,
+        # апдейты приходят разом, поэтому вопросы одного пользователя идут
+        # подряд и с LM_SUPERSEDE склеивались бы (см. TurnTracker)
+        "LM_SUPERSEDE": args.supersede,
+        "CACHE_ENABLED": False,
+        "STATE_DB_PATH": os.path.join(db_dir, "state.sqlite3"),
+        "METRICS_PORT": None,
+        "WORKER_BASE_PORT": args.base_port,
+        "CLUSTER_SLOTS_PORT": args.base_port - 1,
+        "POLL_TIMEOUT": 1,
+    }
+    for k, v in overrides.items():
+        setattr(bot, k, v)
+
+    stop = asyncio.Event()
+    t0 = time.perf_counter()
+    cluster = asyncio.create_task(bot.run_cluster(args.workers, overrides, stop))
+    while state["offset"] <= len(updates) and not cluster.done():
+        await asyncio.sleep(0.05)
+    fetched = time.perf_counter() - t0
+    stop.set()  # плавная остановка: воркеры дорабатывают всё принятое
+    await cluster
+    elapsed = time.perf_counter() - t0
+    await tg_runner.cleanup()
+    await lm_runner.cleanup()
+
+    replies = calls["sendMessage"]
+    print(f"воркеров: {args.workers}, пользователей: {args.users}, апдейтов: {len(updates)}")
+    print(f"все апдейты забраны фронтом за {fetched:.2f} с, обработаны и сброшены на диск за {elapsed:.2f} с")
+    print(f"апдейтов/с: {len(updates) / elapsed:.1f}, ответов модели/с: {calls['sendChatAction'] / elapsed:.1f}")
+    print("вызовы Bot API:", dict(calls.most_common()))
+    prompts, expected = calls["sendChatAction"], args.users * args.messages
+    if args.supersede:
+        # склеенные и перебитые вопросы до модели не доходят, но последний
+        # вопрос каждого пользователя — обязательно
+        print(f"до модели дошло {prompts} сообщений из {expected}, остальные склеены или перебиты")
+        if prompts < args.users:
+            print(f"ВНИМАНИЕ: ответ получили не все {args.users} пользователей")
+    elif prompts != expected:
+        print(f"ВНИМАНИЕ: до модели дошло {prompts} сообщений из {expected}")
+    print(f"база состояния: {overrides['STATE_DB_PATH']} (сообщений отправлено: {replies})")
+
+
+# ======== МИКРОБЕНЧМАРКИ ========
+
+def run_micro(args) -> None:
+    def bench(name: str, fn, number: int) -> None:
+        best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        print(f"{name:<48} {best * 1e6:>10.1f} мкс")
+
+    text = ("Sure, here is the answer. " + "Это предложение ответа модели, довольно длинное. " * 80)
+    long_text = "\n".join(["Абзац с текстом ответа, который нужно порезать на части."] * 400)
+
+    def turn(session: bot.ChatSession) -> None:
+        bot.append_history(session, bot.Role.USER, "Вопрос пользователя " * 10)
+        bot.append_history(session, bot.Role.ASSISTANT, "Ответ модели, несколько предложений. " * 20)
+        bot.trim_history_for_budget(session, bot.DEFAULT_MAX_TOKENS)
+
+    session = bot.ChatSession("чат 1")
+    for _ in range(bot.MAX_MESSAGES_PER_CHAT):
+        turn(session)
+
+    def stream_filter() -> None:
+        filt = bot.RussianStreamFilter()
+        for i in range(0, len(text), 8):
+            filt.feed(text[i:i + 8])
+        filt.final()
+
+    bench("trim_history_for_budget (ход в полном чате)", lambda: turn(session), args.number)
+    bench("lm_messages (полный чат)", lambda: bot.lm_messages(session.history), args.number)
+    bench(f"chunk_plain_text ({len(long_text)} симв.)", lambda: bot.chunk_plain_text(long_text), args.number)
+    bench(f"render_chunks ({len(long_text)} симв.)", lambda: bot.render_chunks(long_text), args.number)
+    bench(f"strip_english_preface+filter ({len(text)} симв.)",
+          lambda: bot.filter_russian_sentences(bot.strip_english_preface(text)), args.number)
+    bench(f"RussianStreamFilter по 8 симв. ({len(text)} симв.)", stream_filter, max(1, args.number // 10))
+    print(f"{'память состояния пользователя (без текста реплик)':<48} {user_state_bytes() / 1024:>10.1f} КиБ")
+
+
+def user_state_bytes(chats: int = 5, turns: int = 20, ids: int = bot.MAX_TRACKED_MSG_IDS) -> int:
+    """user_data типичного активного пользователя: chats чатов по turns ходов,
+    по ids отслеживаемых id сообщений бота и пользователя в каждом."""
+    question, answer = "Вопрос пользователя", "Ответ модели"  # общие строки: считаем только структуру
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    user_data = {"temperature": bot.DEFAULT_TEMPERATURE, "max_tokens": bot.DEFAULT_MAX_TOKENS, "chats": {}}
+    mid = itertools.count(10_000_000)
+    for c in range(chats):
+        session = user_data["chats"][f"chat_{c + 1}"] = bot.ChatSession(f"чат {c + 1}")
+        for _ in range(turns):
+            bot.append_history(session, bot.Role.USER, question)
+            bot.append_history(session, bot.Role.ASSISTANT, answer)
+        for _ in range(ids):
+            session.user_message_ids.append(next(mid))
+            session.bot_message_ids.append(next(mid))
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    load = sub.add_parser("load", help="нагрузочный прогон хендлеров")
+    load.add_argument("--users", type=int, default=1000)
+    load.add_argument("--messages", type=int, default=3, help="сообщений к модели на пользователя")
+    load.add_argument("--concurrency", type=int, default=100, help="пользователей одновременно")
+    load.add_argument("--lm-concurrency", type=int, default=8, help="слотов к заглушке LM")
+    load.add_argument("--lm-ttft", type=float, default=0.05, help="задержка до первого токена, с")
+    load.add_argument("--lm-token-delay", type=float, default=0.0, help="задержка между токенами, с")
+    load.add_argument("--lm-tokens", type=int, default=40)
+    load.add_argument("--tg-latency", type=float, default=0.0, help="задержка фейкового Bot API, с")
+    load.add_argument("--edit-interval", type=float, default=None, help="STREAM_EDIT_INTERVAL (по умолчанию как в bot.py)")
+    load.add_argument("--no-stream", dest="stream", action="store_false")
+    load.add_argument("--cache", action="store_true", help="включить кеш ответов")
+
+    cluster = sub.add_parser("cluster", help="фронт и воркеры отдельными процессами (bot.py --workers)")
+    cluster.add_argument("--workers", type=int, default=2)
+    cluster.add_argument("--users", type=int, default=200)
+    cluster.add_argument("--messages", type=int, default=2, help="сообщений к модели на пользователя")
+    cluster.add_argument("--lm-concurrency", type=int, default=8, help="слотов к заглушке LM на всех")
+    cluster.add_argument("--lm-ttft", type=float, default=0.05)
+    cluster.add_argument("--lm-token-delay", type=float, default=0.0)
+    cluster.add_argument("--lm-tokens", type=int, default=40)
+    cluster.add_argument("--base-port", type=int, default=18600, help="WORKER_BASE_PORT (на порт ниже — слоты модели)")
+    cluster.add_argument("--no-stream", dest="stream", action="store_false")
+    cluster.add_argument("--supersede", action="store_true",
+                         help="LM_SUPERSEDE: подряд идущие вопросы склеиваются")
+
+    micro = sub.add_parser("micro", help="микробенчмарки текстовых утилит")
+    micro.add_argument("--number", type=int, default=1000)
+
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.mode == "load":
+        asyncio.run(run_load(args))
+    elif args.mode == "cluster":
+        asyncio.run(run_cluster(args))
+    else:
+        run_micro(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,56 @@
+import os
 import re
+import argparse
+import atexit
+import html
+import math
+import json
+import time
+import pickle
+import hashlib
+import signal
+import sqlite3
+import asyncio
 import logging
+import logging.handlers
+import queue
+import bisect
+import heapq
+import functools
+import itertools
+import multiprocessing
 import aiohttp
-from dataclasses import dataclass
-from typing import Dict, List, Optional
+from aiohttp import web
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
-    PicklePersistence,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    PersistenceInput,
 )
 
 # ======== КОНФИГ ========
 
 TELEGRAM_BOT_TOKEN = "................."
+TELEGRAM_API_URL = "https://api.telegram.org"  # или локальный Bot API-сервер
 LM_STUDIO_URL = "........................."
 MODEL_NAME = "............."
 
@@ -30,9 +63,99 @@ SYSTEM_PROMPT = (
 DEFAULT_TEMPERATURE = 0.7
 DEFAULT_MAX_TOKENS = 1024
 
+# Таймаут ожидания ответа LM Studio (между кусками ответа) и установки соединения
+LM_TIMEOUT = 120
+LM_CONNECT_TIMEOUT = 5
+
+# HTTP-клиент к бэкендам создаётся при старте: пул соединений с keep-alive
+# и кешем DNS; JSON — orjson, если он установлен
+LM_POOL_SIZE = 64           # соединений на все бэкенды
+LM_POOL_PER_HOST = 16
+LM_KEEPALIVE = 75           # сек простоя соединения в пуле
+LM_DNS_CACHE_TTL = 300
+LM_JSON_CODEC = "orjson"    # или "json"
+# Перед приёмом апдейтов: /v1/models и крошечный запрос с системным
+# промптом — модель загружена, префикс промпта в KV-кеше
+LM_WARMUP = True
+LM_WARMUP_TIMEOUT = 180
+
+# Пул OpenAI-совместимых бэкендов (у каждого своё имя модели)
+LM_BACKENDS = [
+    {"url": LM_STUDIO_URL, "model": MODEL_NAME},
+]
+LM_ROUTING = "least_outstanding"  # или "latency": с учётом наблюдаемой задержки
+LM_RETRIES = 1              # повторов на другом бэкенде после сетевой ошибки/5xx
+LM_BREAKER_FAILURES = 3     # ошибок подряд — бэкенд выводится из ротации
+LM_BREAKER_COOLDOWN = 30    # сек до пробного запроса к выведенному бэкенду
+LM_HEALTH_INTERVAL = 15     # сек между проверками /v1/models
+LM_HEALTH_TIMEOUT = 5
+
+# Модели разного размера, от быстрой к большой. Модель подходит запросу, если
+# промпт не длиннее её max_prompt_tokens (None — без ограничения). Если
+# пользователь задал /setmax, предпочтительнее модели, чей max_completion_tokens
+# его вмещает; иначе max_tokens урезается до предела модели (о том, что
+# заданное через /setmax урезано, бот сообщает). Из подходящих берётся та, что
+# ответит раньше: (занятые + ждущие + 1) / max_concurrent × её средняя
+# задержка. У каждой модели своя очередь: max_concurrent и max_queue, по
+# умолчанию LM_MAX_CONCURRENT и LM_QUEUE_LIMIT. Пользователь может закрепить
+# модель командой /model. backends по умолчанию — LM_BACKENDS. Пример
+# быстрой модели:
+#   {"name": "qwen2.5-3b", "backends": [{"url": LM_STUDIO_URL, "model": "qwen2.5-3b-instruct"}],
+#    "max_prompt_tokens": 1500, "max_completion_tokens": 512},
+LM_MODELS = [
+    {"name": MODEL_NAME},
+]
+
+# Очередь к каждой модели: одновременно генерируется не больше LM_MAX_CONCURRENT
+# ответов, остальные ждут (по кругу между пользователями); сверх
+# LM_QUEUE_LIMIT ожидающих — сразу отказ
+LM_MAX_CONCURRENT = 2
+LM_QUEUE_LIMIT = 50
+
+# Новое сообщение пользователя, пока модель ещё отвечает на прошлое: прошлый
+# запрос отменяется (слот бэкенда освобождается), недописанный ответ в историю
+# не попадает. Сообщения, пришедшие не дальше LM_COALESCE_WINDOW друг от друга,
+# уходят модели одной репликой.
+LM_SUPERSEDE = True
+LM_COALESCE_WINDOW = 3.0  # сек
+
+# Кеш готовых ответов на одинаковые короткие диалоги («привет» в новом чате)
+CACHE_ENABLED = True
+CACHE_MAX_ENTRIES = 1000
+CACHE_TTL = 6 * 3600               # сек
+CACHE_TEMPERATURE_THRESHOLD = 0.75 # кешируем только при temperature ниже
+CACHE_MAX_MESSAGES = 4             # длиннее диалоги не хешируем — повторов там не бывает
+CACHE_DB_PATH: Optional[str] = None  # напр. "lm_cache.sqlite3" — второй уровень на диске
+CACHE_DB_MAX_ENTRIES = 20_000
+
+# Стриминг ответа: показываем текст по мере генерации
+LM_STREAM = True
+STREAM_EDIT_INTERVAL = 1.0  # сек между edit_message_text одного сообщения
+
 # «Память»
 MAX_MESSAGES_PER_CHAT = 200
-MAX_CONTEXT_CHARS = 24_000
+MODEL_CONTEXT_TOKENS = 8192  # окно контекста модели; на историю остаётся это минус max_tokens
+
+# Подсчёт токенов: локальный токенайзер модели (tokenizer.json, нужен пакет
+# tokenizers) или, если его нет, оценка по числу символов
+TOKENIZER_PATH: Optional[str] = None
+CHARS_PER_TOKEN = 3.0  # для русского текста; английский ~4
+MESSAGE_TOKEN_OVERHEAD = 4  # разметка роли в шаблоне чата
+
+# Окно контекста при переполнении: "drop" — выкидывать старые реплики по две
+# (начало промпта сдвигается каждый ход и бэкенд заново считает весь префикс),
+# "compact" — разом сворачивать большой кусок старых реплик в краткое
+# содержание, так что префикс «системный промпт + содержание» не меняется
+# много ходов подряд и LM Studio/llama.cpp переиспользует KV-кеш
+CONTEXT_WINDOWING = "compact"
+COMPACT_TRIGGER = 0.9   # сворачиваем, когда история заняла такую долю бюджета
+COMPACT_FRACTION = 0.6  # доля старых реплик, уходящая в содержание за раз
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_PROMPT = (
+    "Кратко перескажи по-русски предыдущий разговор пользователя с ассистентом: "
+    "факты о пользователе, его просьбы, принятые решения и открытые вопросы. "
+    "Только содержание, без вступлений."
+)
 
 # Telegram лимиты
 TG_TEXT_LIMIT = 4096
@@ -40,11 +163,89 @@ TG_TEXT_LIMIT = 4096
 # Ограничим длину списков id сообщений
 MAX_TRACKED_MSG_IDS = 700
 
+# Удаление сообщений чата (/reset, /deletechat, переключение)
+DELETE_BATCH_SIZE = 100     # предел deleteMessages
+DELETE_CONCURRENCY = 4      # одновременных запросов на удаление
+DELETE_IN_BACKGROUND = True # не ждать удаления перед ответом
+
+# Исходящие вызовы Bot API идут через общую очередь: не больше TG_GLOBAL_RATE
+# в секунду на весь бот и TG_CHAT_RATE в один чат (в группы — TG_GROUP_RATE);
+# ответы пользователю уходят раньше правок стрима, удалений и прочего
+TG_RATE_LIMIT = True
+TG_GLOBAL_RATE = 30.0
+TG_CHAT_RATE = 1.0
+TG_CHAT_BURST = 3           # столько сообщений в чат можно отправить разом
+TG_GROUP_RATE = 20 / 60
+TG_FLOOD_RETRIES = 3        # повторов после RetryAfter (выждав, сколько сказал Telegram)
+TG_CONNECTION_POOL_SIZE = 256  # соединений к Bot API
+
+# Поиск по истории чатов (/search)
+SEARCH_MAX_CHATS = 10
+SEARCH_MAX_TERMS = 8
+SEARCH_SNIPPET_CHARS = 160
+
+# Хранилище состояния
+STATE_DB_PATH = "bot_state.sqlite3"
+LEGACY_PICKLE_PATH = "bot_state.pickle"  # старый PicklePersistence, переносится один раз
+PERSISTENCE_FLUSH_INTERVAL = 60  # сек между сбросами на диск
+
+# Память под состояние пользователей: у тех, кто молчит CHAT_PAGE_OUT_IDLE сек,
+# неактивные чаты выгружаются на диск (в памяти остаётся имя) и читаются
+# обратно при переключении; пока оценка занятой памяти выше
+# USER_STATE_MEMORY_LIMIT, из памяти целиком уходят давно молчащие (LRU)
+USER_STATE_MEMORY_LIMIT = 256 * 1024 * 1024  # байт
+CHAT_PAGE_OUT_IDLE = 60
+USER_EVICT_IDLE = 600  # раньше пользователя не выгружаем, даже если память кончилась
+USER_STATE_GC_INTERVAL = 30
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_PORT: Optional[int] = None  # None — не поднимать; например 9464
+METRICS_HOST = "127.0.0.1"
+# Трассировка апдейтов в лог; без перезапуска: GET /trace?enable=1 (или 0)
+TRACE_ENABLED = False
+
+# Логи: хендлеры только кладут запись в очередь (при переполнении она
+# отбрасывается), форматирует и пишет фоновый поток
+LOG_LEVEL = logging.INFO
+LOG_FORMAT = "text"         # или "json": одна JSON-запись на строку
+LOG_FILE: Optional[str] = None  # None — stderr
+LOG_QUEUE_SIZE = 10_000
+# Тексты диалога в логе: "full", "truncate" (первые LOG_CONTENT_CHARS),
+# "sample" (целиком, но только у доли LOG_CONTENT_SAMPLE апдейтов), "off" (только длина)
+LOG_CONTENT = "truncate"
+LOG_CONTENT_CHARS = 200
+LOG_CONTENT_SAMPLE = 0.05
+LOG_REDACT = True           # маскировать e-mail, телефоны и номера карт
+
+# Апдейты разных пользователей обрабатываются параллельно (не больше
+# MAX_CONCURRENT_UPDATES сразу), апдейты одного пользователя — строго по очереди
+MAX_CONCURRENT_UPDATES = 256
+
+# Webhook вместо polling: Telegram шлёт апдейты на WEBHOOK_URL, обратный прокси
+# с TLS передаёт их на локальный aiohttp-сервер WEBHOOK_LISTEN:WEBHOOK_PORT
+WEBHOOK_URL: Optional[str] = None  # напр. "https://bot.example.com/tg" — None: polling
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET: Optional[str] = None  # заголовок X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = 100  # параллельных соединений со стороны Telegram
+
+# Несколько процессов: python bot.py --workers N. Фронт принимает апдейты
+# (polling или webhook) и по user_id отдаёт каждого пользователя одному из N
+# воркеров; состояние у всех в общей базе STATE_DB_PATH
+WORKER_HOST = "127.0.0.1"
+WORKER_BASE_PORT = 8600     # воркер i слушает WORKER_BASE_PORT + i
+WORKER_BATCH_SIZE = 100     # апдейтов в одном запросе к воркеру
+WORKER_RETRY_DELAY = 1.0    # сек между попытками достучаться до воркера
+WORKER_DRAIN_TIMEOUT = 60   # сек на доработку принятых апдейтов при остановке
+CLUSTER_SLOTS_PORT = 8599   # фронт раздаёт воркерам слоты моделей (ws://WORKER_HOST:порт/slots)
+POLL_TIMEOUT = 30           # long polling getUpdates, сек
+
 # Тексты кнопок
 BTN_NEW_CHAT   = "Начать новый чат"
 BTN_LIST_CHATS = "История чатов"
 BTN_DONATE     = "Пожертвовать автору"
 BTN_BACK       = "Назад"
+_BUTTONS = frozenset({BTN_NEW_CHAT, BTN_LIST_CHATS, BTN_DONATE, BTN_BACK})
 
 # Текст пожертвований
 DONATE_MESSAGE = (
@@ -58,53 +259,705 @@ DONATE_MESSAGE = (
     "Если отправили — напишите «поддержал», я скажу спасибо. ☕🚀"
 )
 
-logging.basicConfig(
-    format="%(asctime)s — %(name)s — %(levelname)s — %(message)s",
-    level=logging.INFO,
-)
 logger = logging.getLogger(__name__)
 
 
+# ======== ЛОГИ ========
+
+_REDACT_RES = (
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), "<email>"),
+    (re.compile(r"\b(?:\d[ -]?){13,19}\b"), "<card>"),
+    (re.compile(r"(?<!\w)\+?\d[\d ()-]{8,}\d"), "<phone>"),
+)
+# атрибуты, которые есть у любой LogRecord; остальное — поля из extra=
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+def redact(text: str) -> str:
+    for pattern, mask in _REDACT_RES:
+        text = pattern.sub(mask, text)
+    return text
+
+class LogText:
+    """Текст диалога в аргументах записи лога. Обрезка, выборка и маскировка
+    (LOG_CONTENT, LOG_REDACT) делаются в __str__, то есть уже в потоке записи;
+    sample_key (update_id) решает, попадёт ли апдейт в выборку при "sample"."""
+    __slots__ = ("text", "sample_key")
+
+    def __init__(self, text: str, sample_key: Optional[int] = None):
+        self.text = text
+        self.sample_key = sample_key
+
+    def __str__(self) -> str:
+        text, mode = self.text, LOG_CONTENT
+        if mode == "sample":
+            sampled = self.sample_key is not None and (self.sample_key * 2654435761) % 10_000 < LOG_CONTENT_SAMPLE * 10_000
+            mode = "full" if sampled else "off"
+        if mode == "off":
+            return f"<{len(text)} симв.>"
+        if LOG_REDACT:  # до обрезки, чтобы не оставить половину номера
+            text = redact(text)
+        if mode == "truncate" and len(text) > LOG_CONTENT_CHARS:
+            text = f"{text[:LOG_CONTENT_CHARS]}… (+{len(text) - LOG_CONTENT_CHARS} симв.)"
+        return text
+
+class LogFormatter(logging.Formatter):
+    """Текстовый формат с полями из extra= в конце строки или JSON."""
+
+    def __init__(self, as_json: bool = False):
+        super().__init__("%(asctime)s — %(name)s — %(levelname)s — %(message)s")
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS}
+        if not self.as_json:
+            line = super().format(record)
+            if fields:
+                head, sep, tail = line.partition("\n")  # traceback — после полей
+                line = head + " " + " ".join(f"{k}={v}" for k, v in fields.items()) + sep + tail
+            return line
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **fields,
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь как есть: msg % args, traceback и JSON
+    считаются в потоке QueueListener. Если очередь полна — запись теряется
+    (bot_log_dropped_total), event loop не ждёт диск."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Логи процесса через очередь и фоновый поток (см. LOG_*)."""
+    target = logging.FileHandler(LOG_FILE, encoding="utf-8") if LOG_FILE else logging.StreamHandler()
+    target.setFormatter(LogFormatter(as_json=LOG_FORMAT == "json"))
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(NonBlockingQueueHandler(q))
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(q, target)
+    listener.start()
+    atexit.register(listener.stop)  # дописать очередь при выходе
+    return listener
+
+
+# ======== МЕТРИКИ ========
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{n}="{v}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        return tuple(labels[n] for n in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_fmt_labels(self.labels, key)} {value}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        # для счётчиков, которые ведёт сам объект (кеш и т.п.)
+        self._values[self._key(labels)] = value
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets or (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            data[0][i] += 1
+        data[1] += value
+        data[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self._values.items():
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                labels = _fmt_labels(self.labels, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {acc}")
+            labels = _fmt_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = ()) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+METRICS = MetricsRegistry()
+
+HANDLER_SECONDS = METRICS.histogram("bot_handler_seconds", "Время обработки апдейта хендлером", ("handler",))
+HANDLERS_IN_FLIGHT = METRICS.gauge("bot_handlers_in_flight", "Апдейты в обработке", ("handler",))
+LM_TTFB_SECONDS = METRICS.histogram("bot_lm_ttfb_seconds", "Время до заголовков ответа LM", ("backend",))
+LM_SECONDS = METRICS.histogram("bot_lm_seconds", "Полное время запроса к LM", ("backend",))
+LM_IN_FLIGHT = METRICS.gauge("bot_lm_requests_in_flight", "Запросы к LM в работе", ("backend",))
+LM_ERRORS = METRICS.counter("bot_lm_errors_total", "Ошибки бэкендов LM", ("backend",))
+LM_PROMPT_TOKENS = METRICS.histogram(
+    "bot_lm_prompt_tokens", "Размер промпта, токенов (оценка)",
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768),
+)
+LM_COMPLETION_CHARS = METRICS.histogram(
+    "bot_lm_completion_chars", "Длина ответа модели, символов",
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+LM_QUEUE_WAIT_SECONDS = METRICS.histogram("bot_lm_queue_wait_seconds", "Ожидание слота LM")
+LM_QUEUE_ACTIVE = METRICS.gauge("bot_lm_queue_active", "Занятые слоты LM")
+LM_QUEUE_WAITING = METRICS.gauge("bot_lm_queue_waiting", "Запросы в очереди к LM")
+LM_QUEUE_REJECTED = METRICS.counter("bot_lm_queue_rejected_total", "Отказы из-за переполненной очереди")
+LM_ROUTED = METRICS.counter("bot_lm_routed_total", "Выбор модели для запроса", ("model", "reason"))
+LM_MODEL_SECONDS = METRICS.histogram("bot_lm_model_seconds", "Время ответа модели", ("model",))
+LM_MODEL_PENDING = METRICS.gauge("bot_lm_model_pending", "Запросы к модели в работе", ("model",))
+LM_SUPERSEDED = METRICS.counter("bot_lm_superseded_total", "Ответы, перебитые новым сообщением", ("result",))
+CACHE_EVENTS = METRICS.counter("bot_lm_cache_total", "Обращения к кешу ответов", ("result",))
+REPLY_CHUNKS = METRICS.histogram("bot_reply_chunks", "Сообщений на один ответ", buckets=(1, 2, 3, 4, 6, 8, 12))
+TG_CALLS = METRICS.counter("bot_telegram_calls_total", "Вызовы Bot API", ("method",))
+TG_ERRORS = METRICS.counter("bot_telegram_errors_total", "Ошибки Bot API", ("method",))
+TG_SECONDS = METRICS.histogram("bot_telegram_call_seconds", "Время вызова Bot API", ("method",))
+DELETE_SECONDS = METRICS.histogram("bot_delete_seconds", "Удаление сообщений сессии")
+TG_QUEUE_SECONDS = METRICS.histogram("bot_telegram_queue_seconds", "Ожидание в очереди к Bot API", ("priority",))
+TG_QUEUE_WAITING = METRICS.gauge("bot_telegram_queue_waiting", "Вызовы Bot API в очереди")
+TG_SKIPPED = METRICS.counter("bot_telegram_skipped_total", "Пропущенные промежуточные вызовы Bot API", ("method",))
+TG_FLOOD_WAITS = METRICS.counter("bot_telegram_flood_waits_total", "Ответы RetryAfter от Telegram", ("method",))
+PERSIST_FLUSH_SECONDS = METRICS.histogram("bot_persistence_flush_seconds", "Запись состояния в SQLite")
+USER_STATE_RESIDENT = METRICS.gauge("bot_user_state_resident_users", "Пользователи, чьё состояние в памяти")
+USER_STATE_BYTES = METRICS.gauge("bot_user_state_bytes", "Оценка памяти под состояние пользователей")
+USER_STATE_PAGE_OUTS = METRICS.counter("bot_user_state_page_outs_total", "Выгрузки на диск", ("kind",))
+LOG_DROPPED = METRICS.counter("bot_log_dropped_total", "Записи лога, потерянные из-за полной очереди")
+
+class Tracer:
+    """Трассировка апдейтов: при enabled каждый апдейт получает trace id,
+    а trace_span пишет в лог длительность своих участков."""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+
+TRACER = Tracer(TRACE_ENABLED)
+_trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        logger.info("trace=%s span=%s %.1f ms %s", trace_id, name, (time.perf_counter() - t0) * 1000, attrs or "")
+
+def timed_handler(fn):
+    """Метрики (время, апдейты в работе) и трассировка для хендлера."""
+    name = fn.__name__.lstrip("_")
+
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        token = None
+        if TRACER.enabled and _trace_id.get() is None:
+            token = _trace_id.set(str(update.update_id))
+        HANDLERS_IN_FLIGHT.inc(handler=name)
+        t0 = time.perf_counter()
+        try:
+            with trace_span(name):
+                return await fn(update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, handler=name)
+            HANDLERS_IN_FLIGHT.dec(handler=name)
+            if token is not None:
+                _trace_id.reset(token)
+
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, считающий вызовы Bot API, их ошибки и время по методам."""
+
+    async def do_request(self, url: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        TG_CALLS.inc(method=api_method)
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, *args, **kwargs)
+        except Exception:
+            TG_ERRORS.inc(method=api_method)
+            raise
+        finally:
+            TG_SECONDS.observe(time.perf_counter() - t0, method=api_method)
+        if code >= 400:
+            TG_ERRORS.inc(method=api_method)
+        return code, payload
+
+
 # ======== ДАННЫЕ СЕССИЙ ========
 
-@dataclass
+class Role(str, Enum):
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+
+class Message:
+    """Реплика истории чата; tokens — кеш подсчёта токенов (см. message_tokens),
+    _wire — кеш её JSON для запроса к модели (см. wire)."""
+    __slots__ = ("role", "content", "tokens", "_wire")
+
+    def __init__(self, role: Role, content: str, tokens: Optional[int] = None):
+        self.role = Role(role)
+        self.content = content
+        self.tokens = tokens
+        self._wire: Optional[bytes] = None
+
+    def wire(self) -> bytes:
+        """{"role": ..., "content": ...} в JSON; считается один раз за жизнь реплики."""
+        if self._wire is None:
+            self._wire = json_dumps({"role": self.role.value, "content": self.content})
+        return self._wire
+
+    @classmethod
+    def restore(cls, role: str, content: str) -> "Message":
+        """Реплика из хранилища; системный промпт — общий объект SYSTEM_MESSAGE."""
+        if role == Role.SYSTEM and content == SYSTEM_PROMPT:
+            return SYSTEM_MESSAGE
+        return cls(role, content)
+
+    def __reduce__(self):
+        if self is SYSTEM_MESSAGE:
+            return "SYSTEM_MESSAGE"  # после загрузки — снова один объект на всех
+        return Message, (self.role.value, self.content, self.tokens)
+
+    def __repr__(self) -> str:
+        return f"Message({self.role.value!r}, {self.content[:40]!r})"
+
+# Одна системная реплика на все чаты всех пользователей; её не меняют —
+# краткое содержание дописывается только в копию для запроса (lm_messages)
+SYSTEM_MESSAGE = Message(Role.SYSTEM, SYSTEM_PROMPT)
+
+class IdRing:
+    """Последние capacity id сообщений в array('q'): добавление O(1), самые
+    старые id перезаписываются по кругу, без сдвига списка."""
+    __slots__ = ("capacity", "_buf", "_start")
+
+    def __init__(self, ids: Iterable[int] = (), capacity: Optional[int] = None):
+        self.capacity = MAX_TRACKED_MSG_IDS if capacity is None else capacity
+        self._buf = array("q")
+        self._start = 0
+        self.extend(ids)
+
+    def append(self, mid: int) -> None:
+        if len(self._buf) < self.capacity:
+            self._buf.append(mid)
+        else:
+            self._buf[self._start] = mid
+            self._start = (self._start + 1) % self.capacity
+
+    def extend(self, ids: Iterable[int]) -> None:
+        for mid in ids:
+            self.append(mid)
+
+    def last(self) -> Optional[int]:
+        return self._buf[self._start - 1] if self._buf else None
+
+    def tolist(self) -> List[int]:
+        """id от старых к новым."""
+        return self._buf[self._start:].tolist() + self._buf[:self._start].tolist()
+
+    def clear(self) -> None:
+        self._buf = array("q")
+        self._start = 0
+
+    def __len__(self) -> int:
+        return len(self._buf)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __reduce__(self):
+        return IdRing, (self.tolist(), self.capacity)
+
 class ChatSession:
-    name: str
-    history: List[Dict]
-    bot_message_ids: List[int]
-    user_message_ids: List[int]
+    """Чат пользователя. history_tokens/summary_tokens — нарастающие итоги
+    (None — пересчитать), summary — краткое содержание свёрнутой части.
+    У выгруженного на диск чата (paged_out) в памяти только имя."""
+    __slots__ = ("name", "history", "bot_message_ids", "user_message_ids",
+                 "summary", "history_tokens", "summary_tokens")
+
+    def __init__(
+        self,
+        name: str,
+        history: Optional[List[Message]] = None,
+        bot_message_ids: Iterable[int] = (),
+        user_message_ids: Iterable[int] = (),
+        summary: Optional[str] = None,
+    ):
+        self.name = name
+        self.history: List[Message] = [SYSTEM_MESSAGE] if history is None else history
+        self.bot_message_ids = IdRing(bot_message_ids)
+        self.user_message_ids = IdRing(user_message_ids)
+        self.summary = summary
+        self.history_tokens: Optional[int] = None
+        self.summary_tokens: Optional[int] = None
+
+    @classmethod
+    def paged(cls, name: str) -> "ChatSession":
+        chat = cls(name)
+        chat.page_out()
+        return chat
+
+    @property
+    def paged_out(self) -> bool:
+        return self.history is None
+
+    def page_out(self) -> None:
+        self.history = None
+        self.bot_message_ids = self.user_message_ids = None
+        self.summary = self.history_tokens = self.summary_tokens = None
+
+    def footprint(self) -> int:
+        """Грубая оценка занятой памяти в байтах: строки реплик (кириллица —
+        по 2 байта на символ), объекты Message, массивы id."""
+        if self.history is None:
+            return 200
+        return (
+            400
+            + sum(2 * len(m.content) + 130 + (len(m._wire) + 33 if m._wire else 0) for m in self.history)
+            + 8 * (len(self.bot_message_ids) + len(self.user_message_ids))
+        )
+
+    @classmethod
+    def from_dict(cls, chat: dict) -> "ChatSession":
+        """Чат в старом формате (словарь из PicklePersistence)."""
+        return cls(
+            chat["name"],
+            [Message.restore(m["role"], m["content"]) for m in chat.get("history", [])],
+            chat.get("bot_message_ids", ()),
+            chat.get("user_message_ids", ()),
+            chat.get("summary") or None,
+        )
 
 # user_data:
 # {
 #   'temperature': float,
 #   'max_tokens': int,
-#   'chats': {'chat_1': {...}}, 'active_chat': 'chat_1', 'next_index': int
+#   'chats': {'chat_1': ChatSession}, 'active_chat': 'chat_1', 'next_index': int,
+#   'chat_index': {нормализованное имя: 'chat_1'}  # производное, на диск не пишется
 # }
 
 
 # ======== ТЕКСТ-УТИЛЫ ========
 
+CYRILLIC_RE = re.compile(r"[А-ЯЁа-яё]")
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s*')
+RUS_SENTENCE_RE = re.compile(r'^\s*[А-ЯЁ]')
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+# Markdown модели и наших текстов: ```блок```, `код`, [текст](url), **жирный**,
+# __жирный__, *жирный* (как в Markdown Telegram), _курсив_, # заголовок.
+# Незакрытые и «висячие» символы разметки остаются обычным текстом.
+MD_TOKEN_RE = re.compile(
+    r"(?=[`\[*_#])"  # быстрый отсев позиций без символов разметки
+    r"(?:```(?P<lang>[^\n`]*)\n?(?P<pre>[\s\S]*?)```"
+    r"|`(?P<code>[^`\n]+)`"
+    r"|\[(?P<ltext>[^\]\n]+)\]\((?P<url>(?:https?|tg)://[^)\s]+)\)"
+    r"|(?P<b2>\*\*|__)(?=\S)(?P<b2text>[^\n]+?)(?<=\S)(?P=b2)"
+    r"|(?<![\w*])\*(?=[^\s*])(?P<btext>[^*\n]+?)(?<=\S)\*(?!\*)"
+    r"|(?<![\w_])_(?=[^\s_])(?P<itext>[^_\n]+?)(?<=\S)_(?![\w_])"
+    r"|^\#{1,6}[ \t]+(?P<htext>[^\n]+?)[ \t#]*$)",
+    re.M,
+)
+
 def strip_english_preface(text: str) -> str:
-    m = re.search(r"[А-ЯЁа-яё]", text)
+    m = CYRILLIC_RE.search(text)
     return text[m.start():] if m else text
 
 def filter_russian_sentences(text: str) -> str:
-    parts = re.split(r'(?<=[.!?])\s*', text)
-    rus = [p for p in parts if re.match(r'^\s*[А-ЯЁ]', p.strip())]
+    parts = SENTENCE_SPLIT_RE.split(text)
+    rus = [p for p in parts if RUS_SENTENCE_RE.match(p.strip())]
     return " ".join(rus).strip() if rus else text.strip()
 
+# Поиск: слова сравниваются в нижнем регистре, с «е» вместо «ё» и без
+# типичных русских окончаний, чтобы «чаты», «чатов» и «чату» нашли друг друга
+WORD_RE = re.compile(r"\w+")
+_RU_ENDINGS = tuple(sorted({
+    "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "иям", "иях", "ием",
+    "ешь", "ишь", "ете", "ите", "ала", "ило", "ыла",
+    "ов", "ев", "ей", "ой", "ый", "ий", "ая", "яя", "ое", "ее", "ые", "ие", "ом", "ем",
+    "ам", "ям", "ах", "ях", "ую", "юю", "ть", "ет", "ит", "ут", "ют", "ат", "ят", "ла", "ло", "ли",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+}, key=len, reverse=True))
+_MIN_STEM = 3
+# глагольные окончания совпадают с концом существительных (отчёт, ответ,
+# билет): их отрезаем, только если от слова остаётся побольше
+_RU_VERB_ENDINGS = frozenset({"ешь", "ишь", "ете", "ите", "ет", "ит", "ут", "ют", "ат", "ят"})
+_MIN_VERB_STEM = 4
+
+def _strip_ending(word: str) -> str:
+    for ending in _RU_ENDINGS:
+        min_stem = _MIN_VERB_STEM if ending in _RU_VERB_ENDINGS else _MIN_STEM
+        if word.endswith(ending) and len(word) - len(ending) >= min_stem:
+            return word[:-len(ending)]
+    return word
+
+def search_term(word: str) -> str:
+    word = word.lower().replace("ё", "е")
+    if not CYRILLIC_RE.match(word):
+        return word
+    for suffix in ("ся", "сь"):
+        if word.endswith(suffix) and len(word) - 2 >= _MIN_STEM:
+            word = word[:-2]
+            break
+    # второй проход сводит «приветы» → «привет» к тому же, что и «привет»
+    return _strip_ending(_strip_ending(word))
+
+def search_terms(text: str) -> List[str]:
+    """Различные слова текста (кроме однобуквенных) в виде для поиска, в порядке появления."""
+    return list(dict.fromkeys(search_term(w) for w in WORD_RE.findall(text) if len(w) > 1))
+
+def search_snippet(text: str, terms: Iterable[str], width: int = SEARCH_SNIPPET_CHARS) -> str:
+    """Кусок text вокруг первого найденного слова."""
+    wanted = set(terms)
+    start = 0
+    for m in WORD_RE.finditer(text):
+        if search_term(m.group()) in wanted:
+            start = m.start()
+            break
+    lo = max(0, start - width // 3)
+    snippet = " ".join(text[lo:lo + width].split())
+    return ("…" if lo else "") + snippet + ("…" if lo + width < len(text) else "")
+
+class RussianStreamFilter:
+    """strip_english_preface + filter_russian_sentences для растущего текста.
+    Завершённые предложения проверяются один раз, заново режется только хвост."""
+
+    def __init__(self):
+        self._raw: List[str] = []
+        self._started = False
+        self._pending = ""
+        self._accepted = ""
+
+    def feed(self, delta: str) -> None:
+        self._raw.append(delta)
+        if not self._started:
+            m = CYRILLIC_RE.search(delta)
+            if not m:
+                return
+            self._started = True
+            delta = delta[m.start():]
+        self._pending += delta
+        parts = SENTENCE_SPLIT_RE.split(self._pending)
+        for p in parts[:-1]:
+            p = p.strip()
+            if RUS_SENTENCE_RE.match(p):
+                self._accepted = f"{self._accepted} {p}" if self._accepted else p
+        self._pending = parts[-1]
+
+    @property
+    def received(self) -> bool:
+        return bool(self._raw)
+
+    @property
+    def stable(self) -> str:
+        """Префикс, который уже не изменится в финальном ответе."""
+        return self._accepted
+
+    @property
+    def text(self) -> str:
+        """Текущий вид ответа (стабильная часть + недописанное предложение)."""
+        if not self._started:
+            return ""
+        tail = self._pending.strip()
+        if not self._accepted:
+            return tail
+        if tail and RUS_SENTENCE_RE.match(tail):
+            return f"{self._accepted} {tail}"
+        return self._accepted
+
+    def final(self) -> str:
+        return filter_russian_sentences(strip_english_preface("".join(self._raw)))
+
+# Кусок размеченного текста: (видимый текст, открытые теги [(открыть, закрыть)])
+Run = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_BOLD = ("<b>", "</b>")
+_ITALIC = ("<i>", "</i>")
+_CODE = ("<code>", "</code>")
+
+def parse_markdown(text: str, tags: Tuple[Tuple[str, str], ...] = ()) -> List[Run]:
+    """Один проход по Markdown: список кусков с тегами Telegram HTML."""
+    runs: List[Run] = []
+    pos = 0
+    for m in MD_TOKEN_RE.finditer(text):
+        if m.start() > pos:
+            runs.append((text[pos:m.start()], tags))
+        if m.group("pre") is not None:
+            lang = m.group("lang").strip()
+            tag = (f'<pre><code class="language-{html.escape(lang)}">', "</code></pre>") if lang else ("<pre>", "</pre>")
+            runs.append((m.group("pre").strip("\n"), tags + (tag,)))
+        elif m.group("code") is not None:
+            runs.append((m.group("code"), tags + (_CODE,)))
+        elif m.group("url") is not None:
+            link = (f'<a href="{html.escape(m.group("url"))}">', "</a>")
+            runs.extend(parse_markdown(m.group("ltext"), tags + (link,)))
+        elif m.group("b2text") is not None:
+            runs.extend(parse_markdown(m.group("b2text"), tags + (_BOLD,)))
+        elif m.group("btext") is not None:
+            runs.extend(parse_markdown(m.group("btext"), tags + (_BOLD,)))
+        elif m.group("itext") is not None:
+            runs.extend(parse_markdown(m.group("itext"), tags + (_ITALIC,)))
+        else:
+            runs.extend(parse_markdown(m.group("htext"), tags + (_BOLD,)))
+        pos = m.end()
+    if pos < len(text):
+        runs.append((text[pos:], tags))
+    return runs
+
+def runs_to_html(runs: List[Run]) -> str:
+    out = []
+    for text, tags in runs:
+        out.extend(o for o, _ in tags)
+        out.append(html.escape(text, quote=False))
+        out.extend(c for _, c in reversed(tags))
+    return "".join(out)
+
+def markdown_to_html(text: str) -> str:
+    return runs_to_html(parse_markdown(text))
+
+def chunk_runs(runs: List[Run], limit: int = TG_TEXT_LIMIT) -> List[List[Run]]:
+    """Режет размеченный текст на сообщения не длиннее limit видимых символов.
+    Сущность, которая целиком влезает в сообщение, не разрезается; длинная
+    (например, блок кода) режется, и теги закрываются/открываются в каждой части."""
+    chunks: List[List[Run]] = []
+    cur: List[Run] = []
+    size = 0
+
+    def flush():
+        nonlocal cur, size
+        if cur:
+            chunks.append(cur)
+        cur, size = [], 0
+
+    for text, tags in runs:
+        while text:
+            room = limit - size
+            if len(text) <= room:
+                cur.append((text, tags))
+                size += len(text)
+                break
+            if cur and tags and len(text) <= limit:
+                flush()
+                continue
+            cut = text.rfind("\n", 0, room)
+            if cut <= 0:
+                cut = text.rfind(" ", 0, room)
+            if cur and cut <= 0:
+                flush()
+                continue
+            if not cur and cut <= limit // 2:
+                cut = room
+            cur.append((text[:cut], tags))
+            text = text[cut:]
+            flush()
+    flush()
+
+    # крайние пробелы сообщения Telegram всё равно срежет; в коде отступ
+    # первой строки значимый, там убираем только переводы строк
+    def blank(tags) -> Optional[str]:
+        return "\n" if any(o.startswith(("<pre", "<code")) for o, _ in tags) else None
+
+    for chunk in chunks:
+        first_text, first_tags = chunk[0]
+        chunk[0] = (first_text.lstrip(blank(first_tags)), first_tags)
+        last_text, last_tags = chunk[-1]
+        chunk[-1] = (last_text.rstrip(blank(last_tags)), last_tags)
+    return [c for c in chunks if any(t for t, _ in c)]
+
+def render_chunks(text: str, limit: int = TG_TEXT_LIMIT) -> List[Tuple[str, str]]:
+    """Markdown -> сообщения [(HTML, тот же текст без разметки)]."""
+    return [(runs_to_html(c), "".join(t for t, _ in c)) for c in chunk_runs(parse_markdown(text), limit)]
+
+def _chunk_cut(s: str, i: int, limit: int) -> int:
+    end = min(i + limit, len(s))
+    cut = s.rfind("\n", i, end)
+    if cut == -1:
+        cut = s.rfind(" ", i, end)
+    if cut == -1 or cut <= i + limit // 2:
+        cut = end
+    return cut
+
 def chunk_plain_text(s: str, limit: int = TG_TEXT_LIMIT) -> List[str]:
     if len(s) <= limit:
         return [s]
     chunks = []
     i = 0
     while i < len(s):
-        end = min(i + limit, len(s))
-        cut = s.rfind("\n", i, end)
-        if cut == -1:
-            cut = s.rfind(" ", i, end)
-        if cut == -1 or cut <= i + limit // 2:
-            cut = end
+        cut = _chunk_cut(s, i, limit)
         chunks.append(s[i:cut].rstrip())
         i = cut
     return chunks
@@ -121,8 +974,8 @@ def main_keyboard() -> ReplyKeyboardMarkup:
         resize_keyboard=True
     )
 
-def chats_keyboard(chats: Dict[str, dict]) -> ReplyKeyboardMarkup:
-    names = [c['name'] for c in chats.values()]
+def chats_keyboard(chats: Dict[str, ChatSession]) -> ReplyKeyboardMarkup:
+    names = [c.name for c in chats.values()]
     rows, row = [], []
     for i, name in enumerate(names, 1):
         row.append(KeyboardButton(name))
@@ -136,10 +989,6 @@ def chats_keyboard(chats: Dict[str, dict]) -> ReplyKeyboardMarkup:
 
 # ======== СЕССИИ ========
 
-def _limit_ids(lst: List[int]) -> None:
-    if len(lst) > MAX_TRACKED_MSG_IDS:
-        del lst[:-MAX_TRACKED_MSG_IDS]
-
 def ensure_user_state(context: ContextTypes.DEFAULT_TYPE) -> None:
     ud = context.user_data
     ud.setdefault("temperature", DEFAULT_TEMPERATURE)
@@ -149,60 +998,385 @@ def ensure_user_state(context: ContextTypes.DEFAULT_TYPE) -> None:
         ud["next_index"] = 1
         chat_id = f"chat_{ud['next_index']}"
         ud["next_index"] += 1
-        ud["chats"][chat_id] = {
-            "name": "чат 1",
-            "history": [{"role": "system", "content": SYSTEM_PROMPT}],
-            "bot_message_ids": [],
-            "user_message_ids": [],
-        }
+        ud["chats"][chat_id] = ChatSession("чат 1")
         ud["active_chat"] = chat_id
 
 def get_active_chat_id(context: ContextTypes.DEFAULT_TYPE) -> str:
     ensure_user_state(context)
     return context.user_data["active_chat"]
 
-def get_active_chat(context: ContextTypes.DEFAULT_TYPE) -> dict:
+def get_active_chat(context: ContextTypes.DEFAULT_TYPE) -> ChatSession:
     return context.user_data["chats"][get_active_chat_id(context)]
 
-def create_new_chat(context: ContextTypes.DEFAULT_TYPE) -> dict:
+def create_new_chat(context: ContextTypes.DEFAULT_TYPE) -> ChatSession:
     ensure_user_state(context)
     idx = context.user_data["next_index"]
     chat_id = f"chat_{idx}"
     context.user_data["next_index"] = idx + 1
     name = f"чат {idx}"
-    context.user_data["chats"][chat_id] = {
-        "name": name,
-        "history": [{"role": "system", "content": SYSTEM_PROMPT}],
-        "bot_message_ids": [],
-        "user_message_ids": [],
-    }
+    context.user_data["chats"][chat_id] = ChatSession(name)
     context.user_data["active_chat"] = chat_id
+    chat_index(context).setdefault(chat_name_key(name), chat_id)
     return context.user_data["chats"][chat_id]
 
-def set_active_chat_by_name(context: ContextTypes.DEFAULT_TYPE, name: str) -> bool:
+async def load_active_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> ChatSession:
+    """Активный чат; выгруженный на диск сначала читается обратно
+    (нужно после смены активного чата)."""
+    session = get_active_chat(context)
+    if session.paged_out:
+        await context.application.persistence.load_chat(
+            update.effective_user.id, get_active_chat_id(context), session
+        )
+    return session
+
+def chat_name_key(name: str) -> str:
+    return name.strip().lower()
+
+def chat_index(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, str]:
+    """Нормализованное имя чата -> chat_id. Строится при первом обращении
+    (пользователь только что прочитан с диска), дальше его поддерживают
+    create_new_chat, rename_chat_to и remove_chat. При совпадении имён
+    побеждает чат, созданный раньше."""
+    return _user_chat_index(context.user_data)
+
+def _user_chat_index(ud: dict) -> Dict[str, str]:
+    index = ud.get("chat_index")
+    if index is None:
+        index = ud["chat_index"] = {}
+        for cid, chat in ud["chats"].items():
+            index.setdefault(chat_name_key(chat.name), cid)
+    return index
+
+def _unindex_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: str, name: str) -> None:
+    index = chat_index(context)
+    key = chat_name_key(name)
+    if index.get(key) != chat_id:
+        return
+    del index[key]
+    for cid, chat in context.user_data["chats"].items():  # редкий случай одинаковых имён
+        if cid != chat_id and chat_name_key(chat.name) == key:
+            index[key] = cid
+            break
+
+def names_chat(ud: dict, text: str) -> bool:
+    """Текст — имя одного из чатов пользователя (кнопка переключения)."""
+    return "chats" in ud and chat_name_key(text) in _user_chat_index(ud)
+
+def find_chat_by_name(context: ContextTypes.DEFAULT_TYPE, name: str) -> Optional[str]:
     ensure_user_state(context)
-    for cid, chat in context.user_data["chats"].items():
-        if chat["name"].strip().lower() == name.strip().lower():
-            context.user_data["active_chat"] = cid
-            return True
-    return False
+    return chat_index(context).get(chat_name_key(name))
 
-def trim_history_for_budget(history: List[Dict]) -> List[Dict]:
-    if not history:
-        return history
-    sys = history[0] if history[0].get("role") == "system" else None
-    rest = history[1:] if sys else history[:]
-    if len(rest) > MAX_MESSAGES_PER_CHAT:
-        rest = rest[-MAX_MESSAGES_PER_CHAT:]
+def rename_chat_to(context: ContextTypes.DEFAULT_TYPE, chat_id: str, name: str) -> None:
+    chat = context.user_data["chats"][chat_id]
+    _unindex_chat(context, chat_id, chat.name)
+    chat.name = name
+    chat_index(context).setdefault(chat_name_key(name), chat_id)
+
+def remove_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: str) -> None:
+    chats = context.user_data["chats"]
+    name = chats[chat_id].name
+    del chats[chat_id]
+    _unindex_chat(context, chat_id, name)
+
+def set_active_chat_by_name(context: ContextTypes.DEFAULT_TYPE, name: str) -> bool:
+    cid = find_chat_by_name(context, name)
+    if cid is None:
+        return False
+    context.user_data["active_chat"] = cid
+    return True
+
+# ======== ТОКЕНЫ ========
 
-    def total_chars(parts: List[Dict]) -> int:
-        return sum(len(m.get("content", "")) for m in parts)
+_tokenizer: Optional[Callable[[str], int]] = None
 
-    trimmed = ([sys] if sys else []) + rest
-    while total_chars(trimmed) > MAX_CONTEXT_CHARS and len(rest) > 2:
-        rest = rest[2:] if len(rest) >= 2 else rest[1:]
-        trimmed = ([sys] if sys else []) + rest
-    return trimmed
+def set_tokenizer(fn: Optional[Callable[[str], int]]) -> None:
+    """Подключить счётчик токенов (текст -> число токенов); None — оценка по символам."""
+    global _tokenizer
+    _tokenizer = fn
+
+def load_local_tokenizer(path: str) -> Optional[Callable[[str], int]]:
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        logger.warning("Пакет tokenizers не установлен — токены считаются по длине текста")
+        return None
+    tok = Tokenizer.from_file(path)
+    return lambda text: len(tok.encode(text, add_special_tokens=False).ids)
+
+def count_tokens(text: str) -> int:
+    if _tokenizer is not None:
+        return _tokenizer(text)
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def message_tokens(m: Message) -> int:
+    """Токены сообщения; считаются один раз и кешируются в самом сообщении."""
+    t = m.tokens
+    if t is None:
+        t = m.tokens = count_tokens(m.content) + MESSAGE_TOKEN_OVERHEAD
+    return t
+
+def history_tokens(session: ChatSession) -> int:
+    """Сумма токенов истории чата; ведётся нарастающим итогом."""
+    total = session.history_tokens
+    if total is None:
+        total = session.history_tokens = sum(message_tokens(m) for m in session.history)
+    return total
+
+def append_history(session: ChatSession, role: Role, content: str) -> None:
+    m = Message(role, content)
+    session.history_tokens = history_tokens(session) + message_tokens(m)
+    session.history.append(m)
+
+def drop_last_message(session: ChatSession) -> Message:
+    m = session.history.pop()
+    if session.history_tokens is not None:
+        session.history_tokens -= message_tokens(m)
+    return m
+
+def reset_history(session: ChatSession) -> None:
+    session.history = [SYSTEM_MESSAGE]
+    session.history_tokens = None
+    session.summary = None
+    session.summary_tokens = None
+
+def summary_tokens(session: ChatSession) -> int:
+    summary = session.summary
+    if not summary:
+        return 0
+    t = session.summary_tokens
+    if t is None:
+        t = session.summary_tokens = count_tokens(summary)
+    return t
+
+class LMMessage(dict):
+    """Сообщение запроса к модели: обычный словарь, но помнит реплику
+    истории, из которой сделан, — encode_lm_body берёт её готовый JSON."""
+    __slots__ = ("source",)
+
+    def __init__(self, source: Message):
+        super().__init__(role=source.role.value, content=source.content)
+        self.source = source
+
+def lm_messages(history: List[Message], summary: Optional[str] = None) -> List[Dict]:
+    # краткое содержание свёрнутой части дописывается в системное сообщение,
+    # чтобы префикс промпта был одним и тем же до следующего сворачивания
+    msgs: List[Dict] = [LMMessage(m) for m in history]
+    if summary:
+        note = f"Краткое содержание предыдущей части разговора:\n{summary}"
+        if msgs and msgs[0]["role"] == "system":
+            msgs[0] = {"role": "system", "content": f"{msgs[0]['content']}\n\n{note}"}
+        else:
+            msgs.insert(0, {"role": "system", "content": note})
+    return msgs
+
+def needs_compaction(session: ChatSession, max_tokens: int) -> bool:
+    if CONTEXT_WINDOWING != "compact":
+        return False
+    budget = MODEL_CONTEXT_TOKENS - max_tokens
+    return (
+        history_tokens(session) + summary_tokens(session) > budget * COMPACT_TRIGGER
+        or len(session.history) > MAX_MESSAGES_PER_CHAT * COMPACT_TRIGGER
+    )
+
+def compaction_slab(history: List[Message]) -> Tuple[int, int]:
+    """Границы [start, end) старых реплик, которые сворачиваются за раз:
+    COMPACT_FRACTION истории, конец — перед репликой пользователя."""
+    start = 1 if history and history[0].role is Role.SYSTEM else 0
+    end = start + int((len(history) - start) * COMPACT_FRACTION)
+    while end < len(history) - 1 and history[end].role is not Role.USER:
+        end += 1
+    return start, min(end, len(history) - 1)
+
+def trim_history_for_budget(session: ChatSession, max_tokens: int = DEFAULT_MAX_TOKENS) -> List[Message]:
+    """Обрезает историю чата на месте так, чтобы она вместе с кратким
+    содержанием и ответом (max_tokens) влезала в MODEL_CONTEXT_TOKENS;
+    системный промпт остаётся. В режиме "compact" это запасной вариант,
+    если свернуть историю не удалось.
+    Стоимость — O(выкинутых сообщений) благодаря нарастающему итогу."""
+    history = session.history
+    if not history:
+        return history
+    budget = MODEL_CONTEXT_TOKENS - max_tokens - summary_tokens(session)
+    total = history_tokens(session)
+    start = 1 if history[0].role is Role.SYSTEM else 0
+    end = start
+    if len(history) - start > MAX_MESSAGES_PER_CHAT:
+        end = len(history) - MAX_MESSAGES_PER_CHAT
+        total -= sum(message_tokens(m) for m in history[start:end])
+    while total > budget and len(history) - end > 2:
+        total -= message_tokens(history[end]) + message_tokens(history[end + 1])
+        end += 2
+    if end > start:
+        del history[start:end]
+        session.history_tokens = total
+    return history
+
+
+# ======== ОЧЕРЕДЬ К BOT API ========
+
+TG_PRIORITIES = ("reply", "edit", "housekeeping")
+_TG_PRIORITY = {
+    "sendMessage": 0,
+    "editMessageText": 1,
+    "sendChatAction": 2,
+    "deleteMessage": 2,
+    "deleteMessages": 2,
+}
+_TG_UNLIMITED = frozenset({"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo", "close", "logOut"})
+
+# rate_limit_args вызова, который лучше пропустить, чем ждать (промежуточные
+# правки стрима): если чат или весь бот упёрлись в лимит, бросается SkippedCall
+DROPPABLE = {"droppable": True}
+
+class SkippedCall(Exception):
+    """Вызов Bot API с DROPPABLE не отправлен: лимит занят."""
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "paused_until")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+        self.paused_until = 0.0  # до этого момента Telegram просил не слать (RetryAfter)
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд можно взять токен (0 — сейчас)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        return self.delay(now) == 0 and self.tokens >= self.capacity
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """Все вызовы Bot API проходят через одну очередь с приоритетами (см.
+    TG_PRIORITIES): вызов уходит, когда есть токен и в общем ведре, и в
+    ведре его чата. Чат, упёршийся в свой лимит, не задерживает остальные.
+    RetryAfter ставит на паузу чат (или весь бот, если чата нет), и вызов
+    повторяется на своём прежнем месте в очереди."""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, group_rate: float):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, max(1.0, global_rate), time.monotonic())
+        self._chats: Dict[object, TokenBucket] = {}
+        self._waiting: List[Tuple[int, int, object, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pruned = 0.0
+
+    async def initialize(self) -> None:
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for *_, fut in self._waiting:
+            fut.cancel()
+        self._waiting = []
+
+    def _bucket(self, chat_id: object, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # отрицательные id и @username — группы и каналы
+            group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._chats[chat_id] = (
+                TokenBucket(self.group_rate, 1, now) if group else TokenBucket(self.chat_rate, self.chat_burst, now)
+            )
+        return bucket
+
+    async def _acquire(self, priority: int, seq: int, chat_id: object) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, seq, chat_id, fut))
+        self._wake.set()
+        await fut
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = time.monotonic()
+            wait: Optional[float] = None
+            deferred = []
+            while self._waiting:
+                item = self._waiting[0]
+                fut = item[3]
+                if fut.done():  # отменён, пока ждал
+                    heapq.heappop(self._waiting)
+                    continue
+                global_wait = self._global.delay(now)
+                if global_wait > 0:
+                    wait = global_wait
+                    break
+                heapq.heappop(self._waiting)
+                chat_id = item[2]
+                if chat_id is not None:
+                    bucket = self._bucket(chat_id, now)
+                    chat_wait = bucket.delay(now)
+                    if chat_wait > 0:
+                        deferred.append(item)
+                        wait = chat_wait if wait is None else min(wait, chat_wait)
+                        continue
+                    bucket.take()
+                self._global.take()
+                fut.set_result(None)
+            for item in deferred:
+                heapq.heappush(self._waiting, item)
+            TG_QUEUE_WAITING.set(len(self._waiting))
+            if now - self._pruned > 60:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle(now)}
+                self._pruned = now
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in _TG_UNLIMITED:
+            return await callback(*args, **kwargs)
+        priority = _TG_PRIORITY.get(endpoint, 1)
+        chat_id = data.get("chat_id")
+        droppable = bool(rate_limit_args and rate_limit_args.get("droppable"))
+        if droppable:
+            now = time.monotonic()
+            if self._global.delay(now) > 0 or (chat_id is not None and self._bucket(chat_id, now).delay(now) > 0):
+                TG_SKIPPED.inc(method=endpoint)
+                raise SkippedCall(endpoint)
+        seq = next(self._seq)
+        for attempt in range(TG_FLOOD_RETRIES + 1):
+            t0 = time.monotonic()
+            await self._acquire(priority, seq, chat_id)
+            TG_QUEUE_SECONDS.observe(time.monotonic() - t0, priority=TG_PRIORITIES[priority])
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TG_FLOOD_WAITS.inc(method=endpoint)
+                if attempt == TG_FLOOD_RETRIES and not droppable:
+                    raise
+                delay = _retry_after_seconds(e)
+                logger.warning("Flood control на %s (чат %s): ждём %.0f с", endpoint, chat_id, delay)
+                now = time.monotonic()
+                bucket = self._bucket(chat_id, now) if chat_id is not None else self._global
+                bucket.paused_until = max(bucket.paused_until, now + delay)
+                if droppable:
+                    TG_SKIPPED.inc(method=endpoint)
+                    raise SkippedCall(endpoint) from e
 
 
 # ======== ОПЕРАЦИИ С СООБЩЕНИЯМИ ========
@@ -212,68 +1386,294 @@ async def send_long_text(
     context: ContextTypes.DEFAULT_TYPE,
     text: str,
     reply_markup=None,
-    track_session: Optional[dict] = None,
+    track_session: Optional[ChatSession] = None,
 ):
     chat_id = update.effective_chat.id
-    chunks = chunk_plain_text(text, TG_TEXT_LIMIT)
+    # Markdown (донат-сообщение, ответы модели) один раз разбирается в HTML;
+    # если Telegram всё же не принял кусок — он уходит простым текстом
+    chunks = render_chunks(text, TG_TEXT_LIMIT)
+    REPLY_CHUNKS.observe(len(chunks))
     sent_ids: List[int] = []
-    # Включим parse_mode Markdown для красивого донат-сообщения (и других)
-    for idx, part in enumerate(chunks):
+    for idx, (part_html, part_plain) in enumerate(chunks):
         if idx == 0:
-            msg = await update.message.reply_text(part, reply_markup=reply_markup, parse_mode="Markdown")
+            send = lambda t, **kw: update.message.reply_text(t, reply_markup=reply_markup, **kw)
         else:
-            msg = await context.bot.send_message(chat_id=chat_id, text=part, parse_mode="Markdown")
+            send = lambda t, **kw: context.bot.send_message(chat_id=chat_id, text=t, **kw)
+        try:
+            msg = await send(part_html, parse_mode="HTML")
+        except BadRequest:
+            logger.warning("Telegram не принял HTML, отправляем простым текстом", exc_info=True)
+            msg = await send(part_plain)
         sent_ids.append(msg.message_id)
     if track_session is not None:
-        track_session["bot_message_ids"].extend(sent_ids)
-        _limit_ids(track_session["bot_message_ids"])
-
-def track_user_message(update: Update, session: dict) -> None:
+        track_session.bot_message_ids.extend(sent_ids)
+
+class StreamingReply:
+    """Прогрессивный вывод ответа: первое сообщение уходит сразу, дальше —
+    edit_message_text не чаще STREAM_EDIT_INTERVAL. Когда текст перерастает
+    TG_TEXT_LIMIT, текущее сообщение фиксируется и начинается следующее.
+    Пока ответ пишется, текст идёт без разметки; finish режет готовый ответ
+    так же, как send_long_text (render_chunks), и правит под это уже
+    отправленные сообщения.
+
+    push не ждёт Telegram: промежуточный вывод идёт фоновой задачей, которая
+    показывает самый свежий текст, а правку, упёршуюся в лимит чата,
+    пропускает (DROPPABLE). Ждать приходится только finish."""
+
+    def __init__(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        reply_markup=None,
+        track_session: Optional[ChatSession] = None,
+    ):
+        self.update = update
+        self.context = context
+        self.reply_markup = reply_markup
+        self.track_session = track_session
+        self.sent_ids: List[int] = []
+        self._shown: List[str] = []  # что сейчас показано в каждом из sent_ids
+        self._open = False    # последнее сообщение ещё дописывается
+        self._offset = 0      # столько символов ответа уже в зафиксированных сообщениях
+        self._last_edit = 0.0
+        self._latest: Optional[Tuple[str, str]] = None  # ещё не показанные (stable, text)
+        self._flusher: Optional[asyncio.Task] = None
+        self._rendering = False  # фоновая задача сейчас в вызове Bot API
+
+    def push(self, stable: str, text: str) -> None:
+        """stable — префикс text, который уже не изменится (только его можно фиксировать)."""
+        self._latest = (stable, text)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self._latest is not None:
+            wait = self._last_edit + STREAM_EDIT_INTERVAL - time.monotonic()
+            if self._open and wait > 0:
+                await asyncio.sleep(wait)
+            stable, text = self._latest
+            self._latest = None
+            self._rendering = True
+            try:
+                await self._render(stable, text)
+            except SkippedCall:
+                self._last_edit = time.monotonic()  # чат занят — покажем более свежий текст позже
+            except Exception:
+                logger.debug("Промежуточный вывод ответа не удался", exc_info=True)
+            finally:
+                self._rendering = False
+
+    async def _render(self, stable: str, text: str) -> None:
+        while len(text) - self._offset > TG_TEXT_LIMIT and len(stable) - self._offset > TG_TEXT_LIMIT // 2:
+            cut = min(_chunk_cut(text, self._offset, TG_TEXT_LIMIT), len(stable))
+            await self._show(text[self._offset:cut])
+            self._open = False
+            self._offset = cut
+        await self._show(text[self._offset:self._offset + TG_TEXT_LIMIT], droppable=True)
+
+    async def _show(self, part: str, droppable: bool = False) -> None:
+        part = part.strip()
+        if not part:
+            return
+        if not self._open:
+            await self._send(part)
+            self._open = True
+        elif part != self._shown[-1]:
+            await self._edit(len(self.sent_ids) - 1, [(part, None)], droppable=droppable)
+        self._last_edit = time.monotonic()
+
+    async def _stop_flusher(self) -> None:
+        """Промежуточного вывода больше не будет; начатый вызов Bot API
+        доводится до конца, чтобы не потерять id отправленного сообщения."""
+        self._latest = None
+        task, self._flusher = self._flusher, None
+        if task is None or task.done():
+            return
+        if not self._rendering:
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def finish(self, text: str) -> None:
+        await self._stop_flusher()
+        if not self.sent_ids:
+            await send_long_text(self.update, self.context, text,
+                                 reply_markup=self.reply_markup, track_session=self.track_session)
+            return
+        chunks = render_chunks(text, TG_TEXT_LIMIT)
+        for i, (part_html, part_plain) in enumerate(chunks):
+            variants = [(part_html, "HTML"), (part_plain, None)]
+            if i >= len(self.sent_ids):
+                await self._send_variants(variants)
+            elif self._shown[i] not in (part_html, part_plain):
+                await self._edit(i, variants)
+        # готовый ответ короче, чем было показано (финальная фильтрация)
+        extra = self.sent_ids[len(chunks):]
+        if extra:
+            await delete_messages_bulk(self.context.bot, self.update.effective_chat.id, extra)
+            del self.sent_ids[len(chunks):], self._shown[len(chunks):]
+        REPLY_CHUNKS.observe(len(chunks))
+
+    async def _send(self, part: str) -> None:
+        await self._send_variants([(part, None)])
+
+    async def _send_variants(self, variants: List[Tuple[str, Optional[str]]]) -> None:
+        """Отправляет новое сообщение первым вариантом текста, который примет Telegram."""
+        if not self.sent_ids:
+            send = lambda t, **kw: self.update.message.reply_text(t, reply_markup=self.reply_markup, **kw)
+        else:
+            chat_id = self.update.effective_chat.id
+            send = lambda t, **kw: self.context.bot.send_message(chat_id=chat_id, text=t, **kw)
+        for text, parse_mode in variants:
+            try:
+                msg = await send(text, parse_mode=parse_mode)
+                break
+            except BadRequest:
+                if parse_mode is None:
+                    raise
+        self.sent_ids.append(msg.message_id)
+        self._shown.append(text)
+        if self.track_session is not None:
+            self.track_session.bot_message_ids.append(msg.message_id)
+
+    async def _edit(self, index: int, variants: List[Tuple[str, Optional[str]]], droppable: bool = False) -> None:
+        # rate_limit_args есть только у методов ExtBot, не у Message.edit_text
+        bot = self.context.bot
+        kw = {"rate_limit_args": DROPPABLE} if droppable and getattr(bot, "rate_limiter", None) is not None else {}
+        for text, parse_mode in variants:
+            try:
+                await bot.edit_message_text(
+                    text=text,
+                    chat_id=self.update.effective_chat.id,
+                    message_id=self.sent_ids[index],
+                    parse_mode=parse_mode,
+                    **kw,
+                )
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    if parse_mode is None:
+                        raise
+                    continue
+            self._shown[index] = text
+            return
+
+    async def discard(self) -> None:
+        """Удаляет из чата всё, что уже отправлено этим ответом."""
+        await self._stop_flusher()
+        chat_id = self.update.effective_chat.id
+        for mid in self.sent_ids:
+            try:
+                await self.context.bot.delete_message(chat_id=chat_id, message_id=mid)
+            except Exception:
+                pass
+        self.sent_ids = []
+        self._shown = []
+        self._open = False
+        self._offset = 0
+
+def track_user_message(update: Update, session: ChatSession) -> None:
     if update.message:
-        session["user_message_ids"].append(update.message.message_id)
-        _limit_ids(session["user_message_ids"])
+        session.user_message_ids.append(update.message.message_id)
+
+async def _with_flood_retry(call: Callable[[], Awaitable[Any]]) -> Any:
+    """call() с ожиданием на RetryAfter — и без TG_RATE_LIMIT, и когда очередь
+    Bot API уже исчерпала свои повторы."""
+    for attempt in range(TG_FLOOD_RETRIES + 1):
+        try:
+            return await call()
+        except RetryAfter as e:
+            if attempt == TG_FLOOD_RETRIES:
+                raise
+            delay = _retry_after_seconds(e)
+            logger.warning("Flood control при удалении сообщений: ждём %.0f с", delay)
+            await asyncio.sleep(delay)
+
+async def _delete_batch(bot, chat_id: int, ids: List[int]) -> List[int]:
+    """Удаляет пачку (до 100) одним deleteMessages; если Telegram её отверг
+    (BadRequest) — по одному. На flood control ждёт и повторяет пачку, а не
+    рассыпает её на сотню одиночных вызовов. Возвращает id, которые удалить
+    не удалось."""
+    try:
+        await _with_flood_retry(lambda: bot.delete_messages(chat_id=chat_id, message_ids=ids))
+        return []
+    except BadRequest:
+        logger.debug("deleteMessages не прошёл, удаляем по одному", exc_info=True)
+    except Exception:
+        logger.warning("Не удалось удалить %d сообщений в чате %s", len(ids), chat_id, exc_info=True)
+        return list(ids)
+    failed: List[int] = []
+    for i, mid in enumerate(ids):
+        try:
+            await _with_flood_retry(lambda: bot.delete_message(chat_id=chat_id, message_id=mid))
+        except BadRequest:
+            failed.append(mid)
+        except Exception:
+            logger.warning("Не удалось удалить сообщения в чате %s", chat_id, exc_info=True)
+            return failed + ids[i:]
+    return failed
+
+async def delete_messages_bulk(bot, chat_id: int, ids: List[int]) -> List[int]:
+    """Удаляет сообщения пачками по DELETE_BATCH_SIZE, не больше
+    DELETE_CONCURRENCY запросов одновременно. Возвращает неудалённые id."""
+    sem = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def run(batch: List[int]) -> List[int]:
+        async with sem:
+            return await _delete_batch(bot, chat_id, batch)
+
+    batches = [ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(ids), DELETE_BATCH_SIZE)]
+    results = await asyncio.gather(*(run(b) for b in batches))
+    return [mid for failed in results for mid in failed]
 
 async def delete_session_messages(
     context: ContextTypes.DEFAULT_TYPE,
     chat_id: int,
-    session: dict
+    session: ChatSession,
+    background: Optional[bool] = None,
 ):
     """Удаляем сообщения бота и пользователя этой сессии.
-       В личке Telegram удалятся только сообщения бота (ограничение платформы)."""
-    bot_ids = session.get("bot_message_ids", [])
-    user_ids = session.get("user_message_ids", [])
-
-    keep_bot: List[int] = []
-    keep_user: List[int] = []
-
-    for mid in bot_ids:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except Exception:
-            keep_bot.append(mid)
+       В личке Telegram удалятся только сообщения бота (ограничение платформы).
+       Списки id очищаются сразу; с background (по умолчанию DELETE_IN_BACKGROUND)
+       само удаление идёт фоновой задачей, неудалённые id потом возвращаются в сессию."""
+    if background is None:
+        background = DELETE_IN_BACKGROUND
+    bot_ids = session.bot_message_ids.tolist()
+    user_ids = session.user_message_ids.tolist()
+    session.bot_message_ids.clear()
+    session.user_message_ids.clear()
+    if not bot_ids and not user_ids:
+        return
 
-    for mid in user_ids:
+    async def run():
+        t0 = time.perf_counter()
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
+            with trace_span("tg.delete", count=len(bot_ids) + len(user_ids)):
+                failed = set(await delete_messages_bulk(context.bot, chat_id, bot_ids + user_ids))
         except Exception:
-            keep_user.append(mid)
-
-    session["bot_message_ids"] = keep_bot
-    session["user_message_ids"] = keep_user
+            logger.exception("Ошибка при удалении сообщений")
+            failed = set(bot_ids) | set(user_ids)
+        DELETE_SECONDS.observe(time.perf_counter() - t0)
+        if failed and not session.paged_out:
+            # неудалённые — перед теми, что успели появиться за это время
+            session.bot_message_ids = IdRing([mid for mid in bot_ids if mid in failed] + session.bot_message_ids.tolist())
+            session.user_message_ids = IdRing([mid for mid in user_ids if mid in failed] + session.user_message_ids.tolist())
+
+    if background:
+        context.application.create_task(run())
+    else:
+        await run()
 
-def render_session_snippet(session: dict, max_chars: int = 3500) -> str:
-    msgs = session["history"]
+def render_session_snippet(session: ChatSession, max_chars: int = 3500) -> str:
+    msgs = session.history
     if not msgs:
         return "История пуста."
     tail = msgs[-12:]
     lines = []
     for m in tail:
-        role = m.get("role")
-        if role == "system":
+        if m.role is Role.SYSTEM:
             continue
-        prefix = "👤" if role == "user" else "🤖"
-        content = m.get("content", "").strip()
-        content = re.sub(r"\n{3,}", "\n\n", content)
+        prefix = "👤" if m.role is Role.USER else "🤖"
+        content = m.content.strip()
+        content = BLANK_LINES_RE.sub("\n\n", content)
         lines.append(f"{prefix} {content}")
     text = "\n\n".join(lines).strip()
     if len(text) > max_chars:
@@ -282,8 +1682,873 @@ def render_session_snippet(session: dict, max_chars: int = 3500) -> str:
     return text or "История пуста."
 
 
+# ======== LM STUDIO ========
+
+class LMError(Exception):
+    """Ошибка бэкенда, текст которой можно показать пользователю."""
+
+class LMBusy(LMError):
+    """Очередь к модели переполнена."""
+
+class FairScheduler:
+    """Слоты к LM-бэкенду: не больше max_concurrent запросов одновременно,
+    ожидающие обслуживаются по кругу между пользователями — у каждого своя
+    очередь, так что один активный пользователь не может занять все места.
+    Когда ждут уже max_queue запросов, новый сразу получает LMBusy."""
+
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self.served = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._queues: Dict[int, Deque[asyncio.Future]] = {}
+        self._ring: Deque[int] = deque()  # пользователи с ожидающими запросами, по кругу
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        """on_queued(позиция) вызывается, если запросу пришлось встать в очередь."""
+        await self.acquire(user_id, on_queued)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user_id: int, on_queued: Optional[Callable[[int], Awaitable]] = None) -> None:
+        if self.active < self.max_concurrent and not self.waiting:
+            self.active += 1
+            self._record_wait(0.0)
+            return
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            LM_QUEUE_REJECTED.inc()
+            raise LMBusy(f"Сервер занят: в очереди {self.waiting} запросов. Попробуйте чуть позже.")
+
+        fut = asyncio.get_running_loop().create_future()
+        q = self._queues.get(user_id)
+        if q is None:
+            q = self._queues[user_id] = deque()
+            self._ring.append(user_id)
+        position = self._position(user_id, len(q))
+        q.append(fut)
+        self.waiting += 1
+        t0 = time.monotonic()
+        try:
+            if on_queued is not None:
+                try:
+                    await on_queued(position)
+                except Exception:
+                    logger.exception("Не удалось сообщить о месте в очереди")
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # слот уже выдан
+            else:
+                self._remove(user_id, fut)
+            raise
+        self._record_wait(time.monotonic() - t0)
+
+    def release(self) -> None:
+        self.active -= 1
+        while self.active < self.max_concurrent and self._ring:
+            uid = self._ring.popleft()
+            q = self._queues[uid]
+            fut = q.popleft()
+            self.waiting -= 1
+            if q:
+                self._ring.append(uid)
+            else:
+                del self._queues[uid]
+            if not fut.done():
+                self.active += 1
+                fut.set_result(None)
+
+    def _remove(self, user_id: int, fut: asyncio.Future) -> None:
+        q = self._queues.get(user_id)
+        if q is None or fut not in q:
+            return
+        q.remove(fut)
+        self.waiting -= 1
+        if not q:
+            del self._queues[user_id]
+            self._ring.remove(user_id)
+
+    def _position(self, user_id: int, k: int) -> int:
+        """Примерное место (с 1) k-го ожидающего запроса пользователя при обходе по кругу."""
+        ahead = sum(min(len(q), k + 1) for uid, q in self._queues.items() if uid != user_id)
+        return ahead + k + 1
+
+    def _record_wait(self, wait: float) -> None:
+        LM_QUEUE_WAIT_SECONDS.observe(wait)
+        self.served += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        if wait >= 1.0:
+            logger.info("Запрос ждал слот LM %.1f с (в очереди ещё %s)", wait, self.waiting)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "served": self.served,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / self.served if self.served else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+class Superseded(Exception):
+    """Пользователь написал снова, пока модель отвечала; запрос отменён."""
+
+class TurnTracker:
+    """Какие ответы модели сейчас в работе у каждого пользователя.
+    PerUserUpdateProcessor сообщает о каждом текстовом сообщении ещё до
+    очереди пользователя (arrive/leave), поэтому новое сообщение может
+    отменить генерацию, начатую для прошлого: обработчик нового всё равно
+    ждёт, пока закончится старый. Отменённая реплика пользователя остаётся
+    в истории без ответа; если следующая пришла в пределах LM_COALESCE_WINDOW,
+    они склеиваются в одну (coalesce). Переключение на другой чат по имени
+    ответ не перебивает."""
+
+    def __init__(self):
+        # ключ пользователя -> {update_id: (время прихода, текст)}
+        self._arrivals: Dict[Any, Dict[int, Tuple[float, str]]] = {}
+        self._running: Dict[Any, Tuple[asyncio.Task, List[bool], dict]] = {}
+        self._left: Dict[Any, Tuple[float, ChatSession, Message]] = {}
+
+    @staticmethod
+    def is_prompt(update: object) -> bool:
+        """Сообщение, которое может уйти модели: текст, не команда и не кнопка.
+        Имена чатов отсеиваются позже (names_chat), когда известен user_data."""
+        if not isinstance(update, Update) or update.message is None:
+            return False
+        text = update.message.text
+        return bool(text) and not text.startswith("/") and text.strip() not in _BUTTONS
+
+    def arrive(self, key: Any, update: Update) -> None:
+        text = update.message.text
+        self._arrivals.setdefault(key, {})[update.update_id] = (time.monotonic(), text)
+        running = self._running.get(key)
+        if running is not None and LM_SUPERSEDE:
+            task, flag, user_data = running
+            if not names_chat(user_data, text):
+                flag[0] = True
+                task.cancel()
+
+    def leave(self, key: Any, update: Update) -> None:
+        arrivals = self._arrivals.get(key)
+        if arrivals is None:
+            return
+        arrivals.pop(update.update_id, None)
+        if not arrivals:
+            # перебить ответ могло только сообщение, которое ещё здесь
+            del self._arrivals[key]
+            self._left.pop(key, None)
+
+    def newer(self, key: Any, update_id: int, user_data: dict) -> bool:
+        """Пришёл ли после этого апдейта ещё один вопрос пользователя
+        (не переключение чата)."""
+        return LM_SUPERSEDE and any(
+            uid > update_id and not names_chat(user_data, text)
+            for uid, (_, text) in self._arrivals.get(key, {}).items()
+        )
+
+    def coalesce(self, key: Any, update_id: int, session: ChatSession, text: str) -> str:
+        """Если прошлая реплика осталась без ответа из-за этого сообщения и
+        пришла недавно — убирает её из истории и возвращает склеенный текст."""
+        left = self._left.pop(key, None)
+        if left is None:
+            return text
+        arrived, prev_session, prev = left
+        now = self._arrival(key, update_id)
+        if prev_session is not session or session.history[-1] is not prev or now - arrived > LM_COALESCE_WINDOW:
+            return text
+        drop_last_message(session)
+        LM_SUPERSEDED.inc(result="merged")
+        return f"{prev.content}\n\n{text}"
+
+    def skip(self, key: Any, update_id: int, session: ChatSession) -> None:
+        """Обработчик не стал звать модель: за этим сообщением уже есть новее."""
+        self._leave_unanswered(key, update_id, session)
+        LM_SUPERSEDED.inc(result="skipped")
+
+    async def run(self, key: Any, update_id: int, session: ChatSession, user_data: dict, coro: Awaitable):
+        """Выполняет запрос к модели так, чтобы новое сообщение могло его
+        отменить; тогда бросает Superseded."""
+        task = asyncio.ensure_future(coro)
+        flag = [False]
+        self._running[key] = (task, flag, user_data)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if not flag[0] or not task.cancelled():
+                raise
+        finally:
+            if self._running.get(key, (None,))[0] is task:
+                del self._running[key]
+        self._leave_unanswered(key, update_id, session)
+        LM_SUPERSEDED.inc(result="cancelled")
+        raise Superseded()
+
+    def _arrival(self, key: Any, update_id: int) -> float:
+        entry = self._arrivals.get(key, {}).get(update_id)
+        return entry[0] if entry is not None else time.monotonic()
+
+    def _leave_unanswered(self, key: Any, update_id: int, session: ChatSession) -> None:
+        self._left[key] = (self._arrival(key, update_id), session, session.history[-1])
+
+class CompletionCache:
+    """LRU+TTL кеш ответов модели. Ключ — хеш модели, нормализованных
+    сообщений, temperature и max_tokens; кешируются только короткие диалоги
+    при низкой temperature. Если задан db_path, записи дублируются в SQLite
+    и переживают перезапуск."""
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        temperature_threshold: Optional[float] = None,
+        db_path: Optional[str] = None,
+        db_max_entries: Optional[int] = None,
+    ):
+        # None — значение из конфига на момент создания (воркер меняет его после импорта)
+        self.max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.temperature_threshold = (
+            CACHE_TEMPERATURE_THRESHOLD if temperature_threshold is None else temperature_threshold
+        )
+        self.db_path = db_path
+        self.db_max_entries = CACHE_DB_MAX_ENTRIES if db_max_entries is None else db_max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lm-cache") if db_path else None
+        self._puts = 0
+
+    def key(self, payload: dict) -> Optional[str]:
+        """Ключ запроса или None, если такой запрос не кешируется."""
+        messages = payload["messages"]
+        if payload["temperature"] >= self.temperature_threshold or len(messages) > CACHE_MAX_MESSAGES:
+            return None
+        norm = [(m["role"], " ".join(m["content"].split()).casefold()) for m in messages]
+        raw = json.dumps(
+            [payload["model"], norm, payload["temperature"], payload["max_tokens"]],
+            ensure_ascii=False, separators=(",", ":"),
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        item = self._mem.get(key)
+        if item is not None:
+            if now - item[0] < self.ttl:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._mem[key]
+        if self._executor is not None:
+            row = await self._run(self._disk_get, key, now - self.ttl)
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[1]
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, reply: str) -> None:
+        now = time.time()
+        self._remember(key, now, reply)
+        if self._executor is not None:
+            await self._run(self._disk_put, key, now, reply)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._mem),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def close(self) -> None:
+        if self._executor is not None:
+            await self._run(self._disk_close)
+            self._executor.shutdown(wait=False)  # очередь потока уже пуста
+
+    def _remember(self, key: str, created: float, reply: str) -> None:
+        self._mem[key] = (created, reply)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+            self.evictions += 1
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # --- диск (только в потоке self._executor) ---
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, created REAL NOT NULL, reply TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+            self._conn = conn
+        return self._conn
+
+    def _disk_get(self, key: str, min_created: float) -> Optional[Tuple[float, str]]:
+        return self._db().execute(
+            "SELECT created, reply FROM cache WHERE key = ? AND created >= ?", (key, min_created)
+        ).fetchone()
+
+    def _disk_put(self, key: str, created: float, reply: str) -> None:
+        conn = self._db()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, created, reply) VALUES (?, ?, ?)", (key, created, reply))
+            self._puts += 1
+            if self._puts % 100 == 0:
+                conn.execute("DELETE FROM cache WHERE created < ?", (created - self.ttl,))
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.db_max_entries,),
+                )
+
+    def _disk_close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+# ======== HTTP-КЛИЕНТ LM ========
+
+def _std_json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+json_dumps: Callable[[Any], bytes] = _std_json_dumps
+json_loads: Callable[[Any], Any] = json.loads
+
+def load_json_codec(name: str) -> Tuple[Callable[[Any], bytes], Callable[[Any], Any]]:
+    if name == "orjson":
+        try:
+            import orjson
+        except ImportError:
+            logger.warning("Пакет orjson не установлен — JSON через стандартный модуль")
+        else:
+            return orjson.dumps, orjson.loads
+    return _std_json_dumps, json.loads
+
+def set_json_codec(dumps: Callable[[Any], bytes], loads: Callable[[Any], Any]) -> None:
+    """Кодек для тел запросов к модели и её ответов: dumps -> bytes, loads(bytes | str)."""
+    global json_dumps, json_loads
+    json_dumps, json_loads = dumps, loads
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+def encode_lm_body(body: dict) -> bytes:
+    """JSON тела запроса. Сообщения из lm_messages не сериализуются заново:
+    у реплик истории JSON уже посчитан (Message.wire)."""
+    messages = body.get("messages")
+    if not messages:
+        return json_dumps(body)
+    rest = json_dumps({k: v for k, v in body.items() if k != "messages"})
+    parts = b",".join(m.source.wire() if isinstance(m, LMMessage) else json_dumps(m) for m in messages)
+    tail = b"," + rest[1:] if len(rest) > 2 else b"}"
+    return b'{"messages":[' + parts + b"]" + tail
+
+def make_lm_session() -> aiohttp.ClientSession:
+    """Сессия к бэкендам LM: общий пул соединений и таймауты по отдельности
+    на соединение и на чтение (у стрима — между кусками)."""
+    connector = aiohttp.TCPConnector(
+        limit=LM_POOL_SIZE,
+        limit_per_host=LM_POOL_PER_HOST,
+        keepalive_timeout=LM_KEEPALIVE,
+        ttl_dns_cache=LM_DNS_CACHE_TTL,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, connect=LM_CONNECT_TIMEOUT, sock_read=LM_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def lm_session(app) -> aiohttp.ClientSession:
+    """Сессия из on_startup; если её нет (bench.py не зовёт post_init) — создаётся здесь."""
+    session_http: Optional[aiohttp.ClientSession] = app.bot_data.get("lm_session")
+    if session_http is None or session_http.closed:
+        session_http = app.bot_data["lm_session"] = make_lm_session()
+    return session_http
+
+async def warm_up(session_http: aiohttp.ClientSession, pool: "BackendPool") -> None:
+    """Прогрев всех бэкендов: /v1/models и ответ в один токен на системный
+    промпт, чтобы первому пользователю не ждать загрузки модели."""
+    body = {
+        "messages": lm_messages([SYSTEM_MESSAGE, Message(Role.USER, "Привет")]),
+        "temperature": 0,
+        "max_tokens": 1,
+    }
+
+    async def one(backend: LMBackend) -> None:
+        t0 = time.monotonic()
+        try:
+            async with session_http.get(backend.models_url) as resp:
+                await resp.read()
+            async with session_http.post(
+                backend.url, data=encode_lm_body({**body, "model": backend.model}), headers=_JSON_HEADERS
+            ) as resp:
+                await _check_status(resp)
+                await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError, LMError) as e:
+            logger.warning("Не удалось прогреть %s: %r", backend.url, e)
+            return
+        logger.info("Бэкенд %s прогрет за %.1f с", backend.url, time.monotonic() - t0)
+
+    await asyncio.gather(*(one(b) for b in pool.backends))
+
+class BackendFailure(LMError):
+    """Бэкенд ответил 5xx/429 — запрос можно повторить на другом."""
+
+_RETRYABLE = (aiohttp.ClientError, asyncio.TimeoutError, BackendFailure)
+
+class LMBackend:
+    def __init__(self, url: str, model: str):
+        self.url = url
+        self.model = model
+        self.models_url = url.split("/v1/")[0] + "/v1/models"
+        self.outstanding = 0
+        self.latency: Optional[float] = None  # EWMA времени до ответа, сек
+        self.failures = 0                     # ошибок подряд
+        self.open_until = 0.0                 # до этого момента выведен из ротации
+        self.probing = False                  # идёт пробный запрос после паузы
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now: float) -> bool:
+        if self.failures < LM_BREAKER_FAILURES:
+            return True
+        # автомат разомкнут: после паузы пропускаем один пробный запрос
+        return now >= self.open_until and not self.probing
+
+class _Attempt:
+    def __init__(self, backend: LMBackend):
+        self.backend = backend
+        self.started = time.monotonic()
+        self.responded_at: Optional[float] = None
+
+    def responded(self) -> None:
+        """Пришли заголовки ответа — по этому моменту считаем задержку бэкенда."""
+        self.responded_at = time.monotonic()
+
+class BackendPool:
+    """Несколько OpenAI-совместимых бэкендов. Запрос уходит на бэкенд с
+    наименьшим числом запросов в работе (или с наименьшей ожидаемой
+    задержкой), после LM_BREAKER_FAILURES ошибок подряд бэкенд выводится из
+    ротации на LM_BREAKER_COOLDOWN (circuit breaker), фоновые проверки
+    /v1/models возвращают его обратно. Неудавшийся запрос повторяется на
+    другом бэкенде, если вызывающий считает это безопасным."""
+
+    def __init__(
+        self,
+        backends: List[Dict[str, str]],
+        strategy: Optional[str] = None,
+        retries: Optional[int] = None,
+        health_interval: Optional[float] = None,
+    ):
+        self.backends = [LMBackend(b["url"], b["model"]) for b in backends]
+        self.strategy = LM_ROUTING if strategy is None else strategy
+        self.retries = LM_RETRIES if retries is None else retries
+        self.health_interval = LM_HEALTH_INTERVAL if health_interval is None else health_interval
+
+    def pick(self, exclude: List[LMBackend] = ()) -> Optional[LMBackend]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+        if not candidates:
+            return None
+        if self.strategy == "latency":
+            return min(candidates, key=lambda b: (b.outstanding + 1) * (b.latency or 0.0))
+        return min(candidates, key=lambda b: (b.outstanding, b.latency or 0.0))
+
+    async def call(self, fn: Callable[[_Attempt], Awaitable], retry: Callable[[], bool] = lambda: True):
+        """Выполняет fn(attempt) на выбранном бэкенде; при сетевой ошибке или
+        5xx повторяет на другом (не больше self.retries раз и пока retry())."""
+        tried: List[LMBackend] = []
+        while True:
+            backend = self.pick(exclude=tried)
+            if backend is None:
+                raise LMError("Ошибка LM Studio: нет доступных серверов")
+            tried.append(backend)
+            attempt = _Attempt(backend)
+            self._begin(backend)
+            try:
+                result = await fn(attempt)
+            except _RETRYABLE as e:
+                self._end(backend, attempt, ok=False)
+                logger.warning("Бэкенд %s не ответил: %r", backend.url, e)
+                if len(tried) > self.retries or not retry():
+                    raise
+                continue
+            except LMError:
+                self._end(backend, attempt, ok=True)  # бэкенд жив, ошибка в запросе
+                raise
+            except BaseException:
+                self._end(backend, attempt, ok=None)
+                raise
+            self._end(backend, attempt, ok=True)
+            return result
+
+    def _begin(self, backend: LMBackend) -> None:
+        backend.outstanding += 1
+        backend.requests += 1
+        LM_IN_FLIGHT.inc(backend=backend.url)
+        if backend.failures >= LM_BREAKER_FAILURES:
+            backend.probing = True
+
+    def _end(self, backend: LMBackend, attempt: _Attempt, ok: Optional[bool]) -> None:
+        backend.outstanding -= 1
+        backend.probing = False
+        LM_IN_FLIGHT.dec(backend=backend.url)
+        now = time.monotonic()
+        LM_SECONDS.observe(now - attempt.started, backend=backend.url)
+        if attempt.responded_at is not None:
+            LM_TTFB_SECONDS.observe(attempt.responded_at - attempt.started, backend=backend.url)
+        if ok is None:
+            return
+        if not ok:
+            LM_ERRORS.inc(backend=backend.url)
+            self._failure(backend)
+            return
+        if backend.failures >= LM_BREAKER_FAILURES:
+            logger.info("Бэкенд %s снова в ротации", backend.url)
+        backend.failures = 0
+        latency = (attempt.responded_at or now) - attempt.started
+        backend.latency = latency if backend.latency is None else 0.7 * backend.latency + 0.3 * latency
+
+    def _failure(self, backend: LMBackend) -> None:
+        backend.errors += 1
+        backend.failures += 1
+        if backend.failures >= LM_BREAKER_FAILURES:
+            if backend.failures == LM_BREAKER_FAILURES:
+                logger.warning("Бэкенд %s выведен из ротации", backend.url)
+            backend.open_until = time.monotonic() + LM_BREAKER_COOLDOWN
+
+    async def health_loop(self, http: aiohttp.ClientSession) -> None:
+        """Периодически проверяет /v1/models у всех бэкендов."""
+        while True:
+            await asyncio.gather(*(self._probe(http, b) for b in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+    async def _probe(self, http: aiohttp.ClientSession, backend: LMBackend) -> None:
+        try:
+            async with http.get(backend.models_url, timeout=aiohttp.ClientTimeout(total=LM_HEALTH_TIMEOUT)) as resp:
+                ok = resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        if not ok:
+            self._failure(backend)
+        elif backend.failures:
+            if backend.failures >= LM_BREAKER_FAILURES:
+                logger.info("Бэкенд %s снова в ротации", backend.url)
+            backend.failures = 0
+            backend.open_until = 0.0
+
+    def stats(self) -> List[Dict]:
+        now = time.monotonic()
+        return [
+            {
+                "url": b.url,
+                "model": b.model,
+                "available": b.available(now),
+                "outstanding": b.outstanding,
+                "latency": b.latency,
+                "requests": b.requests,
+                "errors": b.errors,
+            }
+            for b in self.backends
+        ]
+
+class ModelRoute:
+    """Модель из LM_MODELS: свой пул бэкендов, своя очередь (FairScheduler),
+    пределы запросов, которые ей отдаются, и наблюдаемая нагрузка."""
+
+    def __init__(
+        self,
+        name: str,
+        backends: List[Dict[str, str]],
+        max_prompt_tokens: Optional[int] = None,
+        max_completion_tokens: Optional[int] = None,
+        max_concurrent: Optional[int] = None,
+        max_queue: Optional[int] = None,
+    ):
+        self.name = name
+        self.pool = BackendPool(backends)
+        self.scheduler = FairScheduler(
+            max_concurrent if max_concurrent is not None else LM_MAX_CONCURRENT,
+            max_queue if max_queue is not None else LM_QUEUE_LIMIT,
+        )
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_completion_tokens = max_completion_tokens
+        self.pending = 0                      # запросы к ней в работе
+        self.latency: Optional[float] = None  # EWMA полного времени ответа, сек
+        self.routed = 0
+
+    def fits(self, prompt_tokens: int) -> bool:
+        return self.max_prompt_tokens is None or prompt_tokens <= self.max_prompt_tokens
+
+    def clamp(self, max_tokens: int) -> int:
+        """max_tokens пользователя, урезанный до предела модели."""
+        if self.max_completion_tokens is None:
+            return max_tokens
+        return min(max_tokens, self.max_completion_tokens)
+
+    def available(self, now: float) -> bool:
+        return any(b.available(now) for b in self.pool.backends)
+
+    def expected_wait(self, prior: float) -> float:
+        """Через сколько примерно будет готов ответ: все занятые и ждущие
+        запросы к модели плюс этот, по max_concurrent за раз. Пока задержка
+        не измерена, берётся prior."""
+        latency = self.latency if self.latency is not None else prior
+        s = self.scheduler
+        return (s.active + s.waiting + 1) / s.max_concurrent * latency
+
+class ModelRouter:
+    """Выбирает модель для запроса по дешёвым признакам: длина промпта после
+    trim_history_for_budget, сколько запросов уже у модели в работе и в
+    очереди и её средняя задержка. Короткие реплики уходят быстрой модели,
+    большая остаётся тем, кому она нужна."""
+
+    def __init__(self, models: List[Dict]):
+        self.models = [
+            ModelRoute(
+                m["name"],
+                m.get("backends") or LM_BACKENDS,
+                m.get("max_prompt_tokens"),
+                m.get("max_completion_tokens"),
+                m.get("max_concurrent"),
+                m.get("max_queue"),
+            )
+            for m in models
+        ]
+
+    def get(self, name: Optional[str]) -> Optional[ModelRoute]:
+        return next((m for m in self.models if m.name == name), None)
+
+    def choose(
+        self,
+        prompt_tokens: int,
+        max_tokens: Optional[int] = None,
+        override: Optional[str] = None,
+        reason: str = "auto",
+    ) -> ModelRoute:
+        """max_tokens — длина ответа, которую просили: модели, чей
+        max_completion_tokens её вмещает, предпочтительнее (None — любая,
+        лишнее урежет clamp). reason — метка в bot_lm_routed_total для
+        автоматического выбора (у сворачивания истории своя, "compact")."""
+        route = self.get(override)
+        if route is not None:
+            reason = "override"
+        else:
+            now = time.monotonic()
+            candidates = [m for m in self.models if m.available(now) and m.fits(prompt_tokens)]
+            if max_tokens is not None:
+                candidates = [m for m in candidates if m.clamp(max_tokens) == max_tokens] or candidates
+            if candidates:
+                # неизмеренная модель считается не быстрее самой медленной из
+                # измеренных; при равенстве — та, что раньше в списке
+                prior = max((m.latency for m in self.models if m.latency is not None), default=0.0)
+                route = min(candidates, key=lambda m: m.expected_wait(prior))
+            else:
+                route = self.models[-1]  # ничего не подошло — самой большой
+                reason = "fallback"
+        route.routed += 1
+        LM_ROUTED.inc(model=route.name, reason=reason)
+        return route
+
+    @asynccontextmanager
+    async def track(self, route: ModelRoute):
+        """Учитывает запрос в нагрузке модели; время успешного — в её задержке."""
+        route.pending += 1
+        LM_MODEL_PENDING.set(route.pending, model=route.name)
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            route.pending -= 1
+            LM_MODEL_PENDING.set(route.pending, model=route.name)
+        elapsed = time.monotonic() - t0
+        LM_MODEL_SECONDS.observe(elapsed, model=route.name)
+        route.latency = elapsed if route.latency is None else 0.8 * route.latency + 0.2 * elapsed
+
+    async def health_loop(self, http: aiohttp.ClientSession) -> None:
+        await asyncio.gather(*(m.pool.health_loop(http) for m in self.models))
+
+    def stats(self) -> List[Dict]:
+        return [
+            {
+                "model": m.name, "pending": m.pending, "waiting": m.scheduler.waiting,
+                "latency": m.latency, "routed": m.routed,
+            }
+            for m in self.models
+        ]
+
+async def _check_status(resp: aiohttp.ClientResponse) -> None:
+    if resp.status == 200:
+        return
+    text = await resp.text()
+    logger.error("LM Studio вернул %s: %s", resp.status, text)
+    if resp.status >= 500 or resp.status == 429:
+        raise BackendFailure(f"Ошибка LM Studio: {resp.status}")
+    raise LMError(f"Ошибка LM Studio: {resp.status}")
+
+async def fetch_completion(session_http: aiohttp.ClientSession, pool: BackendPool, payload: dict) -> str:
+    async def attempt(a: _Attempt) -> dict:
+        body = encode_lm_body({**payload, "model": a.backend.model})
+        async with session_http.post(a.backend.url, data=body, headers=_JSON_HEADERS) as resp:
+            a.responded()
+            await _check_status(resp)
+            return json_loads(await resp.read())
+
+    data = await pool.call(attempt)
+    choices = data.get("choices")
+    if not choices:
+        err = data.get("error", {}).get("message", "Неизвестная ошибка")
+        raise LMError(f"Ошибка: {err}")
+    return choices[0]["message"]["content"]
+
+async def iter_sse_deltas(resp: aiohttp.ClientResponse):
+    """Куски content из OpenAI-совместимого SSE-стрима (stream: true)."""
+    async for raw in resp.content:
+        line = raw.decode("utf-8", "replace").strip()
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        chunk = json_loads(data)
+        if "error" in chunk:
+            err = chunk["error"].get("message", "Неизвестная ошибка")
+            raise LMError(f"Ошибка: {err}")
+        choices = chunk.get("choices")
+        if not choices:
+            continue
+        delta = (choices[0].get("delta") or {}).get("content")
+        if delta:
+            yield delta
+
+async def stream_completion(
+    session_http: aiohttp.ClientSession,
+    pool: BackendPool,
+    payload: dict,
+    out: StreamingReply,
+) -> str:
+    """Показывает ответ в Telegram по мере генерации и возвращает финальный
+    текст (уже через strip_english_preface/filter_russian_sentences).
+    Доотправить его должен вызывающий — out.finish(reply)."""
+    filt = RussianStreamFilter()
+
+    async def attempt(a: _Attempt) -> None:
+        body = encode_lm_body({**payload, "model": a.backend.model, "stream": True})
+        async with session_http.post(a.backend.url, data=body, headers=_JSON_HEADERS) as resp:
+            a.responded()
+            await _check_status(resp)
+            async for delta in iter_sse_deltas(resp):
+                filt.feed(delta)
+                out.push(filt.stable, filt.text)
+
+    # повторять на другом бэкенде можно, только пока пользователь ничего не увидел
+    await pool.call(attempt, retry=lambda: not filt.received)
+    return filt.final()
+
+
+async def compact_history(
+    session_http: aiohttp.ClientSession, router: ModelRouter, user_id: int, session: ChatSession
+) -> bool:
+    """Сворачивает большой кусок старых реплик чата в краткое содержание
+    одним запросом к модели (см. CONTEXT_WINDOWING); слот модели — в общей
+    очереди пользователя user_id. Пока модель пишет, чат продолжается:
+    результат вливается в историю, какой она стала к этому моменту.
+    Возвращает True, если история изменилась."""
+    history = session.history
+    start, end = compaction_slab(history)
+    if end <= start:
+        return False
+    slab = history[start:end]
+    lines = []
+    if session.summary:
+        lines.append(f"Ранее: {session.summary}")
+    for m in slab:
+        who = "Пользователь" if m.role is Role.USER else "Ассистент"
+        lines.append(f"{who}: {m.content}")
+    slab_tokens = sum(message_tokens(m) for m in slab)
+    route = router.choose(slab_tokens + summary_tokens(session), SUMMARY_MAX_TOKENS, reason="compact")
+    payload = {
+        "model": route.name,
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": "\n\n".join(lines)},
+        ],
+        "temperature": 0.2,
+        "max_tokens": route.clamp(SUMMARY_MAX_TOKENS),
+    }
+    async with route.scheduler.slot(user_id), router.track(route):
+        summary = strip_english_preface(await fetch_completion(session_http, route.pool, payload)).strip()
+    if not summary:
+        return False
+    # пока ждали модель, в конец дописались новые реплики, а начало могла
+    # срезать trim_history_for_budget; свёрнутое — то, что осталось от slab
+    history = session.history
+    slab_ids = {id(m) for m in slab}
+    end = next((i + 1 for i in range(len(history) - 1, -1, -1) if history[i] is slab[-1]), None)
+    if end is None:
+        return False  # чат сброшен или история заменена
+    start = end - 1
+    while start > 0 and id(history[start - 1]) in slab_ids:
+        start -= 1
+    total = history_tokens(session)
+    dropped = sum(message_tokens(m) for m in history[start:end])
+    del history[start:end]
+    session.history_tokens = total - dropped
+    session.summary = summary
+    session.summary_tokens = count_tokens(summary)
+    logger.info("Свернули %s реплик в краткое содержание (%s токенов)", end - start, session.summary_tokens)
+    return True
+
+def start_compaction(
+    app, session_http: aiohttp.ClientSession, router: ModelRouter, user_id: int, session: ChatSession
+) -> None:
+    """Запускает compact_history фоном, вне очереди апдейтов пользователя:
+    ответ уже отправлен, а следующее сообщение не должно ждать сворачивания.
+    Задачи лежат в bot_data["lm_compactions"] по пользователю; новое
+    сообщение их не прерывает (иначе тот, кто пишет быстрее, чем модель
+    сворачивает, не дождётся сворачивания никогда), отменяет только
+    остановка бота."""
+    tasks: Dict[int, asyncio.Task] = app.bot_data["lm_compactions"]
+    if user_id in tasks:
+        return
+
+    async def run() -> None:
+        try:
+            with trace_span("lm.compact"):
+                if await compact_history(session_http, router, user_id, session):
+                    # user_data поменялась вне хендлера — сама в базу не попадёт
+                    app.mark_data_for_update_persistence(user_ids=[user_id])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.warning("Не удалось свернуть историю чата", exc_info=True)
+        finally:
+            if tasks.get(user_id) is task:
+                del tasks[user_id]
+
+    task = tasks[user_id] = asyncio.create_task(run())
+
+
 # ======== ХЕНДЛЕРЫ ========
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ensure_user_state(context)
     session = get_active_chat(context)
@@ -295,11 +2560,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Команды:\n"
         "/renamechat <новое имя> — переименовать текущий чат\n"
         "/deletechat yes — удалить текущий чат\n"
+        "/search <слова> — найти в истории чатов\n"
         "/donate — реквизиты для поддержки автора 🙏",
         reply_markup=main_keyboard(),
         track_session=session
     )
 
+@timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = get_active_chat(context)
     track_user_message(update, session)
@@ -309,19 +2576,25 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/reset — очистить текущий чат\n"
         "/settemp <0.0–1.0> — температура\n"
         "/setmax <1–2048> — max_tokens\n"
+        "/model <имя|auto> — модель (auto — выбирать по запросу)\n"
         "/renamechat <новое имя> — переименовать текущий чат\n"
         "/deletechat yes — удалить текущий чат\n"
+        "/search <слова> — найти в истории чатов\n"
         "/donate — реквизиты для поддержки автора 🙏\n\n"
         f"Кнопки: {BTN_NEW_CHAT} / {BTN_LIST_CHATS} / {BTN_DONATE}.",
         reply_markup=main_keyboard(),
         track_session=session
     )
 
-async def donate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _donate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = get_active_chat(context)
     track_user_message(update, session)
     await send_long_text(update, context, DONATE_MESSAGE, reply_markup=main_keyboard(), track_session=session)
 
+# кнопка вызывает _donate из handle_message, чтобы время не считалось дважды
+donate = timed_handler(_donate)
+
+@timed_handler
 async def set_temperature(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = get_active_chat(context)
     track_user_message(update, session)
@@ -336,6 +2609,7 @@ async def set_temperature(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["temperature"] = t
     await send_long_text(update, context, f"Температура установлена: {t}", reply_markup=main_keyboard(), track_session=session)
 
+@timed_handler
 async def set_max_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = get_active_chat(context)
     track_user_message(update, session)
@@ -350,13 +2624,36 @@ async def set_max_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["max_tokens"] = m
     await send_long_text(update, context, f"max_tokens установлено: {m}", reply_markup=main_keyboard(), track_session=session)
 
+@timed_handler
+async def set_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session = get_active_chat(context)
+    track_user_message(update, session)
+    router: ModelRouter = context.application.bot_data["lm_router"]
+    names = [m.name for m in router.models]
+    if len(context.args) != 1:
+        current = context.user_data.get("model") or "auto"
+        return await send_long_text(
+            update, context,
+            f"Модель: {current}.\nИспользование: /model <{' | '.join(['auto', *names])}>",
+            track_session=session,
+        )
+    choice = context.args[0]
+    if choice == "auto":
+        context.user_data.pop("model", None)
+    elif choice in names:
+        context.user_data["model"] = choice
+    else:
+        return await send_long_text(update, context, f"Нет такой модели. Доступны: auto, {', '.join(names)}.", track_session=session)
+    await send_long_text(update, context, f"Модель: {choice}", reply_markup=main_keyboard(), track_session=session)
+
+@timed_handler
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ensure_user_state(context)
     chat_id = update.effective_chat.id
     session = get_active_chat(context)
     track_user_message(update, session)
     await delete_session_messages(context, chat_id, session)
-    session["history"] = [{"role": "system", "content": SYSTEM_PROMPT}]
+    reset_history(session)
     await send_long_text(update, context, "Текущий чат очищен!", reply_markup=main_keyboard(), track_session=session)
 
 async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -364,10 +2661,11 @@ async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = get_active_chat(context)
     track_user_message(update, session)
     chats = context.user_data["chats"]
-    names = [c['name'] for c in chats.values()]
+    names = [c.name for c in chats.values()]
     msg = "Выбери чат:\n" + ("\n".join(f"• {n}" for n in names) if names else "Пока нет чатов.")
     await send_long_text(update, context, msg, reply_markup=chats_keyboard(chats), track_session=session)
 
+@timed_handler
 async def rename_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ensure_user_state(context)
     session = get_active_chat(context)
@@ -375,17 +2673,43 @@ async def rename_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await send_long_text(update, context, "Использование: /renamechat <новое имя>", track_session=session)
 
-    new_name = " ".join(context.args).strip()
+    new_name = " ".join(context.args).strip()[:64].strip()
     if not new_name:
         return await send_long_text(update, context, "Имя не должно быть пустым.", track_session=session)
-    for c in context.user_data["chats"].values():
-        if c is not session and c["name"].strip().lower() == new_name.lower():
-            return await send_long_text(update, context, "Такое имя уже используется.", track_session=session)
+    active_id = get_active_chat_id(context)
+    if find_chat_by_name(context, new_name) not in (None, active_id):
+        return await send_long_text(update, context, "Такое имя уже используется.", track_session=session)
 
-    old_name = session["name"]
-    session["name"] = new_name[:64]
-    await send_long_text(update, context, f"Чат «{old_name}» переименован в «{session['name']}».", reply_markup=main_keyboard(), track_session=session)
+    old_name = session.name
+    rename_chat_to(context, active_id, new_name)
+    await send_long_text(update, context, f"Чат «{old_name}» переименован в «{session.name}».", reply_markup=main_keyboard(), track_session=session)
 
+@timed_handler
+async def search_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ensure_user_state(context)
+    session = get_active_chat(context)
+    track_user_message(update, session)
+    terms = search_terms(" ".join(context.args or ()))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return await send_long_text(update, context, "Использование: /search <слова>", track_session=session)
+    persistence = context.application.persistence
+    if not isinstance(persistence, SQLitePersistence):
+        return await send_long_text(update, context, "Поиск сейчас недоступен.", track_session=session)
+
+    found = await persistence.search(update.effective_user.id, context.user_data, terms)
+    chats = context.user_data["chats"]
+    found = [(cid, hits, text) for cid, hits, text in found if cid in chats]
+    if not found:
+        return await send_long_text(update, context, "Ничего не нашлось.", reply_markup=main_keyboard(), track_session=session)
+    lines = [f"• {chats[cid].name} ({hits}): {search_snippet(text, terms)}" for cid, hits, text in found]
+    await send_long_text(
+        update, context,
+        "Нашлось в чатах (нажми, чтобы переключиться):\n\n" + "\n\n".join(lines),
+        reply_markup=chats_keyboard({cid: chats[cid] for cid, _, _ in found}),
+        track_session=session,
+    )
+
+@timed_handler
 async def delete_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ensure_user_state(context)
     ud = context.user_data
@@ -402,7 +2726,7 @@ async def delete_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     await delete_session_messages(context, chat_id_tg, session)
-    del ud["chats"][active_id]
+    remove_chat(context, active_id)
 
     if not ud["chats"]:
         create_new_chat(context)
@@ -410,10 +2734,10 @@ async def delete_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         new_active = next(iter(ud["chats"].keys()))
         ud["active_chat"] = new_active
 
-    new_session = get_active_chat(context)
+    new_session = await load_active_chat(update, context)
     await send_long_text(
         update, context,
-        f"Чат удалён. Активен «{new_session['name']}».",
+        f"Чат удалён. Активен «{new_session.name}».",
         reply_markup=main_keyboard(),
         track_session=new_session
     )
@@ -421,6 +2745,7 @@ async def delete_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if snippet:
         await send_long_text(update, context, f"Последние сообщения:\n\n{snippet}", track_session=new_session)
 
+@timed_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
         return
@@ -435,14 +2760,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # кнопки
     if txt == BTN_NEW_CHAT:
         session = create_new_chat(context)
-        await send_long_text(update, context, f"Создан {session['name']}. Начинай писать 👇", reply_markup=main_keyboard(), track_session=session)
+        await send_long_text(update, context, f"Создан {session.name}. Начинай писать 👇", reply_markup=main_keyboard(), track_session=session)
         return
 
     if txt == BTN_LIST_CHATS:
         return await show_chats(update, context)
 
     if txt == BTN_DONATE:
-        return await donate(update, context)
+        return await _donate(update, context)
 
     if txt == BTN_BACK:
         return await send_long_text(update, context, "Готово.", reply_markup=main_keyboard(), track_session=get_active_chat(context))
@@ -450,87 +2775,1219 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # переключение по имени
     if set_active_chat_by_name(context, txt):
         await delete_session_messages(context, chat_id_tg, current_session)
-        new_session = get_active_chat(context)
-        await send_long_text(update, context, f"Переключился на «{new_session['name']}».", reply_markup=main_keyboard(), track_session=new_session)
+        new_session = await load_active_chat(update, context)
+        await send_long_text(update, context, f"Переключился на «{new_session.name}».", reply_markup=main_keyboard(), track_session=new_session)
         snippet = render_session_snippet(new_session)
         if snippet:
             await send_long_text(update, context, f"Последние сообщения:\n\n{snippet}", track_session=new_session)
         return
 
     # обычный текст — диалог с моделью
-    user_text = txt
+    user_key = update.effective_user.id
     session = get_active_chat(context)
-    logger.info(f"Пользователь: {user_text}")
-
-    session["history"].append({"role": "user", "content": user_text})
-    trimmed = trim_history_for_budget(session["history"])
+    turns: Optional[TurnTracker] = context.application.bot_data.get("lm_turns")
+    user_text = txt
+    if turns is not None:
+        user_text = turns.coalesce(user_key, update.update_id, session, txt)
+    log_fields = {"user_id": user_key, "chat_id": chat_id_tg, "update_id": update.update_id}
+    logger.info("Пользователь: %s", LogText(user_text, update.update_id), extra=log_fields)
+
+    max_tokens = context.user_data["max_tokens"]
+    append_history(session, Role.USER, user_text)
+    if turns is not None and turns.newer(user_key, update.update_id, context.user_data):
+        # следом уже пришло ещё сообщение — отвечать будем на него
+        turns.skip(user_key, update.update_id, session)
+        return
+    trimmed = lm_messages(trim_history_for_budget(session, max_tokens), session.summary)
+    prompt_tokens = history_tokens(session) + summary_tokens(session)
+    LM_PROMPT_TOKENS.observe(prompt_tokens)
 
     await update.message.chat.send_action(ChatAction.TYPING)
 
+    router: ModelRouter = context.application.bot_data["lm_router"]
+    # max_tokens по умолчанию — не пожелание пользователя, его можно урезать молча
+    requested = max_tokens if max_tokens != DEFAULT_MAX_TOKENS else None
+    route = router.choose(prompt_tokens, requested, context.user_data.get("model"))
     payload = {
-        "model": MODEL_NAME,
+        "model": route.name,
         "messages": trimmed,
         "temperature": context.user_data["temperature"],
-        "max_tokens": context.user_data["max_tokens"],
+        "max_tokens": route.clamp(max_tokens),
     }
-
-    session_http: aiohttp.ClientSession = context.application.bot_data.get("lm_session")
-    if session_http is None or session_http.closed:
-        session_http = aiohttp.ClientSession()
-        context.application.bot_data["lm_session"] = session_http
-
+    if requested is not None and payload["max_tokens"] < requested:
+        # о каждом урезании (модель, /setmax) — один раз
+        notice = f"{route.name}:{requested}"
+        if context.user_data.get("clamp_notice") != notice:
+            context.user_data["clamp_notice"] = notice
+            await send_long_text(
+                update, context,
+                f"ℹ️ Модель {route.name} отвечает не длиннее {payload['max_tokens']} токенов, "
+                f"поэтому ответ будет короче /setmax {requested}.",
+                track_session=session,
+            )
+
+    session_http = lm_session(context.application)
+
+    cache: Optional[CompletionCache] = context.application.bot_data.get("lm_cache")
+    cache_key = cache.key(payload) if cache is not None else None
+    out: Optional[StreamingReply] = None
+
+    async def notify_queued(position: int):
+        await send_long_text(update, context, f"⏳ Сервер занят, вы #{position} в очереди.", track_session=session)
+
+    if LM_STREAM:
+        out = StreamingReply(update, context, reply_markup=main_keyboard(), track_session=session)
+
+    async def generate() -> str:
+        with trace_span("lm", stream=LM_STREAM, model=route.name):
+            async with route.scheduler.slot(user_key, on_queued=notify_queued), router.track(route):
+                if out is not None:
+                    return await stream_completion(session_http, route.pool, payload, out)
+                raw = await fetch_completion(session_http, route.pool, payload)
+                return filter_russian_sentences(strip_english_preface(raw))
+
+    t_request = time.perf_counter()
     try:
-        async with session_http.post(LM_STUDIO_URL, json=payload, timeout=120) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                logger.error("LM Studio вернул %s: %s", resp.status, text)
-                return await send_long_text(update, context, f"Ошибка LM Studio: {resp.status}", reply_markup=main_keyboard(), track_session=session)
-
-            data = await resp.json()
-
-        choices = data.get("choices")
-        if not choices:
-            err = data.get("error", {}).get("message", "Неизвестная ошибка")
-            return await send_long_text(update, context, f"Ошибка: {err}", reply_markup=main_keyboard(), track_session=session)
-
-        raw = choices[0]["message"]["content"]
-        reply = filter_russian_sentences(strip_english_preface(raw))
-
-        logger.info(f"Бот: {reply}")
-        session["history"].append({"role": "assistant", "content": reply})
-        session["history"] = trim_history_for_budget(session["history"])
-
-        await send_long_text(update, context, reply, reply_markup=main_keyboard(), track_session=session)
-
+        reply = await cache.get(cache_key) if cache_key else None
+        cached = reply is not None
+        if reply is None:
+            if turns is not None:
+                reply = await turns.run(user_key, update.update_id, session, context.user_data, generate())
+            else:
+                reply = await generate()
+            LM_COMPLETION_CHARS.observe(len(reply))
+            if cache_key and reply:
+                await cache.put(cache_key, reply)
+
+        logger.info(
+            "Бот: %s", LogText(reply, update.update_id),
+            extra={**log_fields, "ms": round((time.perf_counter() - t_request) * 1000), "cached": cached,
+                   "model": route.name},
+        )
+        append_history(session, Role.ASSISTANT, reply)
+        trim_history_for_budget(session, max_tokens)
+
+        with trace_span("tg.reply"):
+            if out is not None:
+                await out.finish(reply)
+            else:
+                await send_long_text(update, context, reply, reply_markup=main_keyboard(), track_session=session)
+
+        # ответ уже у пользователя — теперь можно свернуть старую часть чата
+        if needs_compaction(session, max_tokens):
+            start_compaction(context.application, session_http, router, user_key, session)
+
+    except Superseded:
+        # ответ на следующее сообщение учтёт и это; недописанный — убираем из чата
+        if out is not None:
+            await out.discard()
+    except LMError as e:
+        await send_long_text(update, context, str(e), reply_markup=main_keyboard(), track_session=session)
+    except RetryAfter:
+        # очередь к Bot API уже выждала TG_FLOOD_RETRIES раз; «Упс» упёрся бы в тот же лимит
+        logger.warning("Ответ не доставлен: Telegram не снял flood control")
     except Exception:
         logger.exception("Ошибка при запросе к LM Studio")
         await send_long_text(update, context, "Упс! Что-то пошло не так. Попробуйте позже.", reply_markup=main_keyboard(), track_session=session)
 
+@timed_handler
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = get_active_chat(context)
     track_user_message(update, session)
     await send_long_text(update, context, "Извини, я понимаю только текст.", reply_markup=main_keyboard(), track_session=session)
 
 
+# ======== ХРАНИЛИЩЕ ========
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id  INTEGER PRIMARY KEY,
+    settings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chats (
+    user_id          INTEGER NOT NULL,
+    chat_id          TEXT    NOT NULL,
+    name             TEXT    NOT NULL,
+    bot_message_ids  TEXT    NOT NULL,
+    user_message_ids TEXT    NOT NULL,
+    summary          TEXT    NOT NULL DEFAULT '',
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    user_id INTEGER NOT NULL,
+    chat_id TEXT    NOT NULL,
+    seq     INTEGER NOT NULL,
+    role    TEXT    NOT NULL,
+    content TEXT    NOT NULL,
+    PRIMARY KEY (user_id, chat_id, seq)
+);
+-- обратный индекс для /search: слова (search_term) -> сообщения
+CREATE TABLE IF NOT EXISTS message_terms (
+    user_id INTEGER NOT NULL,
+    term    TEXT    NOT NULL,
+    chat_id TEXT    NOT NULL,
+    seq     INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term, chat_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS message_terms_by_message ON message_terms (user_id, chat_id, seq);
+"""
+# PRAGMA user_version: 1 — message_terms заполнена, 2 — перестроена под
+# нынешний search_term (при его изменении номер увеличивается)
+_SCHEMA_VERSION = 2
+
+_UPSERT_USER = (
+    "INSERT INTO users (user_id, settings) VALUES (?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET settings = excluded.settings"
+)
+_UPSERT_CHAT = (
+    "INSERT INTO chats (user_id, chat_id, name, bot_message_ids, user_message_ids, summary) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (user_id, chat_id) DO UPDATE SET name = excluded.name, "
+    "bot_message_ids = excluded.bot_message_ids, user_message_ids = excluded.user_message_ids, "
+    "summary = excluded.summary"
+)
+_INSERT_MESSAGES = "INSERT INTO messages (user_id, chat_id, seq, role, content) VALUES (?, ?, ?, ?, ?)"
+_DELETE_MESSAGE = "DELETE FROM messages WHERE user_id = ? AND chat_id = ? AND seq = ?"
+_DELETE_MESSAGES = "DELETE FROM messages WHERE user_id = ? AND chat_id = ?"
+_DELETE_CHAT = "DELETE FROM chats WHERE user_id = ? AND chat_id = ?"
+_DELETE_USER_MESSAGES = "DELETE FROM messages WHERE user_id = ?"
+_DELETE_USER_CHATS = "DELETE FROM chats WHERE user_id = ?"
+_DELETE_USER = "DELETE FROM users WHERE user_id = ?"
+_INSERT_TERMS = "INSERT OR IGNORE INTO message_terms (user_id, term, chat_id, seq) VALUES (?, ?, ?, ?)"
+_DELETE_MESSAGE_TERMS = "DELETE FROM message_terms WHERE user_id = ? AND chat_id = ? AND seq = ?"
+_DELETE_CHAT_TERMS = "DELETE FROM message_terms WHERE user_id = ? AND chat_id = ?"
+_DELETE_USER_TERMS = "DELETE FROM message_terms WHERE user_id = ?"
+_SEARCH_MATCH = "SELECT chat_id, seq FROM message_terms WHERE user_id = ? AND term = ?"
+
+def _term_rows(user_id: int, chat_id: str, seq: int, m: Message) -> List[tuple]:
+    if m.role is Role.SYSTEM:
+        return []
+    return [(user_id, term, chat_id, seq) for term in search_terms(m.content)]
+
+def _message_key(m: Message) -> int:
+    """Отпечаток реплики для сравнения с записанной. По identity сравнивать
+    нельзя: PTB отдаёт в update_user_data deepcopy user_data."""
+    return hash((m.role.value, m.content))
+
+@dataclass
+class _ChatShadow:
+    """Что из чата уже лежит в базе: keys — отпечатки записанных сообщений
+    (_message_key) по порядку, seqs — их seq в таблице messages."""
+    sig: tuple = ()
+    keys: List[int] = field(default_factory=list)
+    seqs: List[int] = field(default_factory=list)
+    next_seq: int = 0
+
+    @classmethod
+    def stored(cls, chat: ChatSession, seqs: List[int]) -> "_ChatShadow":
+        """Тень только что прочитанного из базы чата."""
+        return cls(
+            sig=_chat_signature(chat),
+            keys=[_message_key(m) for m in chat.history],
+            seqs=seqs,
+            next_seq=seqs[-1] + 1 if seqs else 0,
+        )
+
+_UNSAVED_KEYS = frozenset({"chats", "chat_index"})  # чаты пишутся отдельно, индекс строится заново
+
+def _settings_json(data: dict) -> str:
+    return json.dumps({k: v for k, v in data.items() if k not in _UNSAVED_KEYS}, ensure_ascii=False, sort_keys=True)
+
+def _chat_signature(chat: ChatSession) -> tuple:
+    b, u = chat.bot_message_ids, chat.user_message_ids
+    return (chat.name, chat.summary or "", len(b), b.last(), len(u), u.last())
+
+class SQLitePersistence(BasePersistence):
+    """user_data в SQLite (WAL): пользователи, чаты и сообщения лежат отдельными
+    строками. При сбросе пишутся только изменившиеся чаты и новые сообщения —
+    всё одной транзакцией; состояние пользователя читается с диска при первом
+    его апдейте, а не целиком на старте, причём история — только у активного
+    чата, остальные подгружаются при переключении (load_chat). collect_idle
+    выгружает из памяти то, что уже записано и давно не нужно. Все обращения
+    к базе идут через один фоновый поток."""
+
+    def __init__(self, filepath: str, update_interval: Optional[float] = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=PERSISTENCE_FLUSH_INTERVAL if update_interval is None else update_interval,
+        )
+        self.filepath = filepath
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._loaded: set = set()
+        self._users: Dict[int, str] = {}  # user_id -> записанный settings
+        self._chats: Dict[int, Dict[str, _ChatShadow]] = {}
+        self._pending: List[Tuple[str, list]] = []
+        self._commit_task: Optional[asyncio.Task] = None
+        # пользователи с изменениями в _pending и в записи, которая идёт сейчас:
+        # их состояние ещё нельзя выгружать из памяти
+        self._pending_users: set = set()
+        self._writing_users: set = set()
+        self._seen: "OrderedDict[int, float]" = OrderedDict()  # LRU: время последнего апдейта
+        self._footprint: Dict[int, int] = {}  # оценка памяти загруженных пользователей
+        self._paged_users: set = set()  # неактивные чаты уже выгружены
+        self._evicting: set = set()  # drop_user_data для них — выгрузка, а не удаление
+
+    # --- доступ к базе (только в потоке self._executor) ---
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.filepath, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chats)")}
+            if "summary" not in columns:  # базы, созданные до свёртки истории
+                conn.execute("ALTER TABLE chats ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                self._index_messages(conn)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _index_messages(conn: sqlite3.Connection) -> None:
+        """Один раз заполняет message_terms для базы, созданной до /search."""
+        with conn:
+            conn.execute("DELETE FROM message_terms")
+            rows = conn.execute("SELECT user_id, chat_id, seq, role, content FROM messages")
+            for user_id, chat_id, seq, role, content in rows:
+                conn.executemany(_INSERT_TERMS, _term_rows(user_id, chat_id, seq, Message.restore(role, content)))
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _write(self, ops: List[Tuple[str, list]]) -> None:
+        conn = self._db()
+        with conn:
+            for sql, rows in ops:
+                conn.executemany(sql, rows)
+
+    def _read_user(self, user_id: int) -> Optional[Tuple[dict, Dict[str, List[int]]]]:
+        """Настройки и чаты пользователя; полностью — только активный чат,
+        остальные выгружены (paged_out)."""
+        conn = self._db()
+        row = conn.execute("SELECT settings FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        active = data.get("active_chat")
+        chats: Dict[str, ChatSession] = {}
+        for (chat_id, name) in conn.execute(
+            "SELECT chat_id, name FROM chats WHERE user_id = ? ORDER BY rowid", (user_id,)
+        ):
+            chats[chat_id] = ChatSession.paged(name)
+        seqs: Dict[str, List[int]] = {}
+        if active in chats:
+            loaded = self._read_chat(user_id, active)
+            if loaded is not None:
+                chats[active], seqs[active] = loaded
+        data["chats"] = chats
+        return data, seqs
+
+    def _read_chat(self, user_id: int, chat_id: str) -> Optional[Tuple[ChatSession, List[int]]]:
+        conn = self._db()
+        row = conn.execute(
+            "SELECT name, bot_message_ids, user_message_ids, summary FROM chats WHERE user_id = ? AND chat_id = ?",
+            (user_id, chat_id),
+        ).fetchone()
+        if row is None:
+            return None
+        name, bot_ids, user_ids, summary = row
+        chat = ChatSession(name, [], json.loads(bot_ids), json.loads(user_ids), summary or None)
+        seqs: List[int] = []
+        for seq, role, content in conn.execute(
+            "SELECT seq, role, content FROM messages WHERE user_id = ? AND chat_id = ? ORDER BY seq",
+            (user_id, chat_id),
+        ):
+            seqs.append(seq)
+            chat.history.append(Message.restore(role, content))
+        return chat, seqs
+
+    def _search(self, user_id: int, terms: List[str], limit: int) -> List[Tuple[str, int, str]]:
+        conn = self._db()
+        matches = " INTERSECT ".join([_SEARCH_MATCH] * len(terms))
+        params: list = []
+        for term in terms:
+            params += [user_id, term]
+        groups = conn.execute(
+            f"SELECT chat_id, count(*), max(seq) FROM ({matches}) GROUP BY chat_id "
+            "ORDER BY count(*) DESC, chat_id LIMIT ?",
+            params + [limit],
+        ).fetchall()
+        found = []
+        for chat_id, hits, seq in groups:
+            row = conn.execute(
+                "SELECT content FROM messages WHERE user_id = ? AND chat_id = ? AND seq = ?",
+                (user_id, chat_id, seq),
+            ).fetchone()
+            if row is not None:
+                found.append((chat_id, hits, row[0]))
+        return found
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # --- вычисление изменений ---
+
+    def _stage_user(self, user_id: int, data: dict) -> List[Tuple[str, list]]:
+        ops: List[Tuple[str, list]] = []
+        settings = _settings_json(data)
+        if self._users.get(user_id) != settings:
+            ops.append((_UPSERT_USER, [(user_id, settings)]))
+            self._users[user_id] = settings
+        chats = data.get("chats", {})
+        shadows = self._chats.setdefault(user_id, {})
+        for chat_id, chat in chats.items():
+            if not chat.paged_out:  # выгруженный чат не менялся с последней записи
+                self._stage_chat(user_id, chat_id, chat, shadows, ops)
+        for chat_id in [cid for cid in shadows if cid not in chats]:
+            del shadows[chat_id]
+            ops.append((_DELETE_CHAT_TERMS, [(user_id, chat_id)]))
+            ops.append((_DELETE_MESSAGES, [(user_id, chat_id)]))
+            ops.append((_DELETE_CHAT, [(user_id, chat_id)]))
+        return ops
+
+    def _stage_chat(
+        self,
+        user_id: int,
+        chat_id: str,
+        chat: ChatSession,
+        shadows: Dict[str, _ChatShadow],
+        ops: List[Tuple[str, list]],
+    ) -> None:
+        shadow = shadows.get(chat_id)
+        sig = _chat_signature(chat)
+        if shadow is None or shadow.sig != sig:
+            ops.append((_UPSERT_CHAT, [(
+                user_id, chat_id, chat.name,
+                json.dumps(chat.bot_message_ids.tolist()), json.dumps(chat.user_message_ids.tolist()),
+                chat.summary or "",
+            )]))
+        if shadow is None:
+            shadow = shadows[chat_id] = _ChatShadow()
+        shadow.sig = sig
+
+        history = chat.history
+        keys = [_message_key(m) for m in history]
+        kept, dropped = self._match_stored(keys, shadow)
+        if not kept and dropped:
+            # история пересобрана (reset и т.п.) — переписываем чат целиком
+            ops.append((_DELETE_CHAT_TERMS, [(user_id, chat_id)]))
+            ops.append((_DELETE_MESSAGES, [(user_id, chat_id)]))
+            shadow.next_seq = 0
+        elif dropped:
+            rows = [(user_id, chat_id, seq) for seq in dropped]
+            ops.append((_DELETE_MESSAGE_TERMS, rows))
+            ops.append((_DELETE_MESSAGE, rows))
+        new = history[kept:]
+        if new:
+            seq = shadow.next_seq
+            ops.append((_INSERT_MESSAGES, [
+                (user_id, chat_id, seq + i, m.role.value, m.content) for i, m in enumerate(new)
+            ]))
+            ops.append((_INSERT_TERMS, [
+                row for i, m in enumerate(new) for row in _term_rows(user_id, chat_id, seq + i, m)
+            ]))
+            shadow.keys.extend(keys[kept:])
+            shadow.seqs.extend(range(seq, seq + len(new)))
+            shadow.next_seq = seq + len(new)
+
+    @staticmethod
+    def _match_stored(keys: List[int], shadow: _ChatShadow) -> Tuple[int, List[int]]:
+        """Сопоставляет историю (keys — её отпечатки) с записанной: записанные
+        сообщения, которые по порядку совпадают с началом истории, остаются,
+        остальные (выкинутые trim_history_for_budget, свёрнутые, перезаписанные)
+        удаляются. Возвращает (сколько сообщений в начале истории уже в базе,
+        seq удаляемых строк); всё после них — новые."""
+        kept_keys: List[int] = []
+        kept_seqs: List[int] = []
+        dropped: List[int] = []
+        i, n = 0, len(keys)
+        for key, seq in zip(shadow.keys, shadow.seqs):
+            if i < n and keys[i] == key:
+                kept_keys.append(key)
+                kept_seqs.append(seq)
+                i += 1
+            else:
+                dropped.append(seq)
+        shadow.keys, shadow.seqs = kept_keys, kept_seqs
+        return i, dropped
+
+    def _schedule_commit(self) -> None:
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._commit())
+
+    async def _commit(self) -> None:
+        # update_user_data всех пользователей одного сброса вызываются пачкой:
+        # даём им сложить изменения и пишем их одной транзакцией
+        await asyncio.sleep(0)
+        while self._pending:
+            ops, self._pending = self._pending, []
+            self._writing_users, self._pending_users = self._pending_users, set()
+            t0 = time.perf_counter()
+            try:
+                await self._run(self._write, ops)
+                PERSIST_FLUSH_SECONDS.observe(time.perf_counter() - t0)
+            except Exception:
+                logger.exception("Не удалось записать состояние в %s", self.filepath)
+                # не знаем, что из этого дошло до базы: при следующем сбросе
+                # загруженные пользователи перепишутся целиком
+                self._users.clear()
+                self._chats.clear()
+            finally:
+                self._writing_users = set()
+
+    def _stage_pending(self, user_id: int, data: dict) -> bool:
+        """Ставит изменения пользователя в очередь записи; False — изменений нет."""
+        ops = self._stage_user(user_id, data)
+        if not ops:
+            return False
+        self._pending.extend(ops)
+        self._pending_users.add(user_id)
+        self._footprint[user_id] = sum(c.footprint() for c in data.get("chats", {}).values())
+        self._schedule_commit()
+        return True
+
+    def _is_flushed(self, user_id: int, data: dict) -> bool:
+        """Всё состояние пользователя уже в базе (несохранённое — отправляется в запись)."""
+        if user_id in self._pending_users or user_id in self._writing_users:
+            return False
+        return not self._stage_pending(user_id, data)
+
+    def _forget(self, user_id: int) -> None:
+        self._loaded.discard(user_id)
+        self._users.pop(user_id, None)
+        self._chats.pop(user_id, None)
+        self._seen.pop(user_id, None)
+        self._footprint.pop(user_id, None)
+        self._paged_users.discard(user_id)
+
+    # --- выгрузка из памяти ---
+
+    async def load_chat(self, user_id: int, chat_id: str, chat: ChatSession) -> None:
+        """Читает выгруженный чат обратно в тот же объект."""
+        if not chat.paged_out:
+            return
+        loaded = await self._run(self._read_chat, user_id, chat_id)
+        if not chat.paged_out:
+            return
+        stored, seqs = loaded if loaded is not None else (ChatSession(chat.name), [])
+        for attr in ChatSession.__slots__:
+            setattr(chat, attr, getattr(stored, attr))
+        shadows = self._chats.setdefault(user_id, {})
+        shadows[chat_id] = _ChatShadow.stored(chat, seqs) if loaded is not None else _ChatShadow()
+        self._paged_users.discard(user_id)
+        self._footprint[user_id] = self._footprint.get(user_id, 0) + chat.footprint()
+
+    def collect_idle(self, application) -> Tuple[int, int]:
+        """Выгружает неактивные чаты пользователей, молчащих CHAT_PAGE_OUT_IDLE,
+        и — пока оценка памяти выше USER_STATE_MEMORY_LIMIT — целиком самых
+        давно молчащих (не меньше USER_EVICT_IDLE). Трогает только уже
+        записанное в базу. Возвращает (выгружено чатов, пользователей)."""
+        now = time.monotonic()
+        user_data = application.user_data
+        paged = 0
+        for user_id, seen in list(self._seen.items()):
+            if now - seen < CHAT_PAGE_OUT_IDLE:
+                break
+            data = user_data.get(user_id)
+            if user_id in self._paged_users or user_id not in self._loaded or not data:
+                continue
+            if not self._is_flushed(user_id, data):
+                continue
+            shadows = self._chats.get(user_id, {})
+            for chat_id, chat in data["chats"].items():
+                if chat_id != data.get("active_chat") and not chat.paged_out:
+                    chat.page_out()
+                    if chat_id in shadows:
+                        shadows[chat_id] = _ChatShadow()
+                    paged += 1
+            self._paged_users.add(user_id)
+            self._footprint[user_id] = sum(c.footprint() for c in data["chats"].values())
+
+        evicted = 0
+        total = sum(self._footprint.values())
+        for user_id, seen in list(self._seen.items()):
+            if total <= USER_STATE_MEMORY_LIMIT or now - seen < USER_EVICT_IDLE:
+                break
+            data = user_data.get(user_id)
+            if data and user_id in self._loaded and not self._is_flushed(user_id, data):
+                continue
+            total -= self._footprint.get(user_id, 0)
+            self._forget(user_id)
+            if user_id in user_data:
+                self._evicting.add(user_id)
+                application.drop_user_data(user_id)
+            evicted += 1
+        USER_STATE_PAGE_OUTS.inc(paged, kind="chat")
+        USER_STATE_PAGE_OUTS.inc(evicted, kind="user")
+        return paged, evicted
+
+    async def search(self, user_id: int, data: dict, terms: List[str], limit: int = SEARCH_MAX_CHATS) -> List[Tuple[str, int, str]]:
+        """Чаты пользователя с сообщениями, где есть все terms (см. search_terms):
+        (chat_id, сколько таких сообщений, текст последнего из них). Перед
+        поиском несохранённые изменения пользователя записываются в базу."""
+        if user_id in self._loaded:
+            self._stage_pending(user_id, data)
+        if self._commit_task is not None and not self._commit_task.done():
+            await asyncio.shield(self._commit_task)
+        return await self._run(self._search, user_id, terms, limit)
+
+    def resident_bytes(self) -> int:
+        return sum(self._footprint.values())
+
+    # --- BasePersistence ---
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        # пользователи подгружаются по одному в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._seen[user_id] = time.monotonic()
+        self._seen.move_to_end(user_id)
+        self._paged_users.discard(user_id)
+        if user_id in self._loaded:
+            return
+        loaded = await self._run(self._read_user, user_id)
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        if loaded is None:
+            return
+        data, seqs = loaded
+        user_data.update(data)
+        self._users[user_id] = _settings_json(user_data)
+        shadows = self._chats[user_id] = {}
+        for chat_id, chat in user_data["chats"].items():
+            if chat.paged_out:
+                shadows[chat_id] = _ChatShadow()  # заполнится в load_chat
+                continue
+            shadows[chat_id] = _ChatShadow.stored(chat, seqs.get(chat_id, []))
+        self._footprint[user_id] = sum(c.footprint() for c in user_data["chats"].values())
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if user_id not in self._loaded:
+            return
+        self._stage_pending(user_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicting:
+            # collect_idle убрал пользователя из памяти; в базе он остаётся
+            self._evicting.discard(user_id)
+            return
+        self._forget(user_id)
+        self._pending.extend([
+            (_DELETE_USER_TERMS, [(user_id,)]),
+            (_DELETE_USER_MESSAGES, [(user_id,)]),
+            (_DELETE_USER_CHATS, [(user_id,)]),
+            (_DELETE_USER, [(user_id,)]),
+        ])
+        self._schedule_commit()
+
+    async def flush(self) -> None:
+        if self._commit_task is not None:
+            await self._commit_task
+        if self._pending:
+            ops, self._pending = self._pending, []
+            await self._run(self._write, ops)
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+    # chat_data, bot_data, callback_data и диалоги бот не использует
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+class _LegacyUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        # PicklePersistence подменяет объект Bot ссылкой — для переноса он не нужен
+        return None
+
+def migrate_pickle_state(pickle_path: str, db_path: str) -> int:
+    """Одноразовый перенос user_data из файла PicklePersistence в SQLite.
+    Возвращает число перенесённых пользователей."""
+    with open(pickle_path, "rb") as f:
+        state = _LegacyUnpickler(f).load()
+    tmp_path = db_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    persistence = SQLitePersistence(tmp_path)
+    ops: List[Tuple[str, list]] = []
+    count = 0
+    for user_id, data in (state.get("user_data") or {}).items():
+        if "chats" in data:
+            data["chats"] = {
+                cid: chat if isinstance(chat, ChatSession) else ChatSession.from_dict(chat)
+                for cid, chat in data["chats"].items()
+            }
+            ops.extend(persistence._stage_user(user_id, data))
+            count += 1
+    try:
+        persistence._write(ops)
+    finally:
+        persistence._close()
+        persistence._executor.shutdown()
+    os.replace(tmp_path, db_path)
+    return count
+
+
 # ======== LIFECYCLE ========
 
+def refresh_runtime_metrics(app) -> None:
+    """Переносит в метрики состояние объектов, которые ведут свою статистику."""
+    router: ModelRouter = app.bot_data["lm_router"]
+    LM_QUEUE_ACTIVE.set(sum(m.scheduler.active for m in router.models))
+    LM_QUEUE_WAITING.set(sum(m.scheduler.waiting for m in router.models))
+    cache: Optional[CompletionCache] = app.bot_data.get("lm_cache")
+    if cache is not None:
+        CACHE_EVENTS.set(cache.hits, result="hit")
+        CACHE_EVENTS.set(cache.misses, result="miss")
+        CACHE_EVENTS.set(cache.evictions, result="eviction")
+    USER_STATE_RESIDENT.set(len(app.user_data))
+    if isinstance(app.persistence, SQLitePersistence):
+        USER_STATE_BYTES.set(app.persistence.resident_bytes())
+
+async def user_state_gc_loop(app) -> None:
+    persistence: SQLitePersistence = app.persistence
+    while True:
+        await asyncio.sleep(USER_STATE_GC_INTERVAL)
+        try:
+            paged, evicted = persistence.collect_idle(app)
+            if paged or evicted:
+                logger.debug("Выгружено на диск: чатов %s, пользователей %s", paged, evicted)
+        except Exception:
+            logger.exception("Ошибка при выгрузке состояния пользователей")
+
+async def start_metrics_server(app) -> web.AppRunner:
+    async def metrics(request: web.Request) -> web.Response:
+        refresh_runtime_metrics(app)
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8")
+
+    async def trace(request: web.Request) -> web.Response:
+        enable = request.query.get("enable")
+        if enable is not None:
+            TRACER.enabled = enable.lower() in ("1", "true", "on", "yes")
+            logger.info("Трассировка %s", "включена" if TRACER.enabled else "выключена")
+        return web.json_response({"enabled": TRACER.enabled})
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", metrics)
+    web_app.router.add_get("/trace", trace)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info("Метрики: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+async def on_startup(app):
+    set_json_codec(*load_json_codec(LM_JSON_CODEC))
+    router: ModelRouter = app.bot_data["lm_router"]
+    session_http = lm_session(app)
+    if LM_WARMUP:
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(warm_up(session_http, m.pool) for m in router.models)), LM_WARMUP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Прогрев бэкендов не уложился в %s с", LM_WARMUP_TIMEOUT)
+    app.bot_data["lm_health_task"] = asyncio.create_task(router.health_loop(session_http))
+    if isinstance(app.persistence, SQLitePersistence):
+        app.bot_data["user_state_gc_task"] = asyncio.create_task(user_state_gc_loop(app))
+    if METRICS_PORT is not None:
+        app.bot_data["metrics_runner"] = await start_metrics_server(app)
+
+async def on_stop(app):
+    """post_stop: апдейты доработаны, но хранилище ещё открыто — фоновые
+    задачи (GC состояния ходит в базу) останавливаются до его flush/close."""
+    tasks = [app.bot_data.get(name) for name in ("lm_health_task", "user_state_gc_task")]
+    tasks = [t for t in tasks if t is not None] + list(app.bot_data["lm_compactions"].values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 async def on_shutdown(app):
+    metrics_runner: Optional[web.AppRunner] = app.bot_data.get("metrics_runner")
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
     session_http: aiohttp.ClientSession = app.bot_data.get("lm_session")
     if session_http and not session_http.closed:
         await session_http.close()
+    cache: Optional[CompletionCache] = app.bot_data.get("lm_cache")
+    if cache is not None:
+        logger.info("Кеш ответов: %s", cache.stats())
+        await cache.close()
+
+
+# ======== ОБРАБОТКА АПДЕЙТОВ ========
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с порядком внутри пользователя:
+    user_data["chats"] меняется хендлерами без блокировок, поэтому два апдейта
+    одного пользователя никогда не выполняются одновременно. Если задан
+    turns (TurnTracker), он узнаёт о сообщении ещё до очереди — чтобы можно
+    было отменить ответ, который это сообщение ждёт."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[Any, asyncio.Lock] = {}
+        self._holders: Dict[Any, int] = {}
+        self.turns: Optional[TurnTracker] = None
+
+    @staticmethod
+    def _key(update: object) -> Any:
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Сначала очередь пользователя, потом общий лимит: ждущие апдейты
+        # одного пользователя не занимают слоты, нужные остальным
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._holders[key] = self._holders.get(key, 0) + 1
+        turns = self.turns if self.turns is not None and TurnTracker.is_prompt(update) else None
+        if turns is not None:
+            turns.arrive(key, update)
+        try:
+            async with lock:  # asyncio.Lock будит ждущих по порядку прихода
+                await super().process_update(update, coroutine)
+        finally:
+            if turns is not None:
+                turns.leave(key, update)
+            left = self._holders[key] - 1
+            if left:
+                self._holders[key] = left
+            else:
+                del self._holders[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+@asynccontextmanager
+async def running_application(app):
+    """initialize/start приложения и обратный порядок на выходе, как в
+    run_polling; апдейты в app.update_queue кладёт вызывающий. app.stop()
+    дорабатывает очередь и начатые апдейты."""
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    try:
+        await app.start()
+        yield app
+    finally:
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+def stop_event(*signals: int) -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in signals:
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def start_webhook_server(deliver: Callable[[dict], Awaitable]) -> web.AppRunner:
+    """aiohttp-сервер webhook: проверяет секрет, отдаёт сырой апдейт в deliver
+    и сразу отвечает Telegram 200."""
+    path = urlsplit(WEBHOOK_URL).path or "/"
+
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await deliver(data)
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_post(path, receive)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    logger.info("Webhook: %s -> http://%s:%s%s", WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, path)
+    return runner
+
+async def run_webhook(app) -> None:
+    """Приём апдейтов через webhook на aiohttp вместо run_polling."""
+    stop = stop_event(signal.SIGINT, signal.SIGTERM)
+    async with running_application(app):
+        runner = await start_webhook_server(lambda data: app.update_queue.put(Update.de_json(data, app.bot)))
+        try:
+            await app.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+
+
+# ======== НЕСКОЛЬКО ПРОЦЕССОВ ========
+
+def shard_for(user_id: Optional[int], workers: int) -> int:
+    """Воркер пользователя; апдейты без пользователя — воркеру 0."""
+    return user_id % workers if user_id is not None else 0
+
+def update_user_id(data: dict) -> Optional[int]:
+    """id отправителя (или чата) из сырого апдейта — без разбора в объекты PTB."""
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+def worker_url(index: int) -> str:
+    return f"http://{WORKER_HOST}:{WORKER_BASE_PORT + index}/updates"
+
+def slots_url() -> str:
+    return f"http://{WORKER_HOST}:{CLUSTER_SLOTS_PORT}/slots"
+
+class RemoteScheduler:
+    """Слоты модели в воркере: очередь к модели одна на все процессы — это
+    FairScheduler у фронта (start_slot_server). Слот берётся по websocket и
+    занят, пока соединение открыто, так что упавший воркер свои слоты не
+    уносит. Снаружи — как FairScheduler; active/waiting — только этого воркера."""
+
+    def __init__(self, url: str, model: str, max_concurrent: int):
+        self.url = url
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.waiting = 0
+        self._http: Optional[aiohttp.ClientSession] = None
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession()
+        self.waiting += 1
+        try:
+            ws = await self._http.ws_connect(self.url, params={"model": self.model, "user": str(user_id)})
+            try:
+                while True:
+                    msg = await ws.receive()
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        raise LMError("Очередь к модели недоступна. Попробуйте позже.")
+                    data = json.loads(msg.data)
+                    if "busy" in data:
+                        raise LMBusy(data["busy"])
+                    if "granted" in data:
+                        break
+                    if on_queued is not None:
+                        try:
+                            await on_queued(data["queued"])
+                        except Exception:
+                            logger.exception("Не удалось сообщить о месте в очереди")
+            except BaseException:
+                await ws.close()
+                raise
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            await ws.close()
 
+    async def close(self) -> None:
+        if self._http is not None:
+            await self._http.close()
 
-# ======== ЗАПУСК ========
+async def start_slot_server(router: "ModelRouter") -> web.AppRunner:
+    """Фронт: выдаёт воркерам слоты моделей из очередей router (см. RemoteScheduler)."""
 
-if __name__ == "__main__":
-    persistence = PicklePersistence(filepath="bot_state.pickle")
+    async def lease(request: web.Request) -> web.WebSocketResponse:
+        route = router.get(request.query.get("model"))
+        if route is None:
+            raise web.HTTPNotFound()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
 
-    app = ApplicationBuilder() \
-        .token(TELEGRAM_BOT_TOKEN) \
-        .persistence(persistence) \
-        .build()
+        async def queued(position: int) -> None:
+            await ws.send_json({"queued": position})
+
+        try:
+            async with route.scheduler.slot(int(request.query["user"]), on_queued=queued):
+                await ws.send_json({"granted": True})
+                async for _ in ws:  # слот занят, пока воркер не закроет соединение
+                    pass
+        except LMBusy as e:
+            await ws.send_json({"busy": str(e)})
+        except ConnectionResetError:
+            pass  # воркер ушёл, не дождавшись слота
+        return ws
+
+    web_app = web.Application()
+    web_app.router.add_get("/slots", lease)
+    # воркер закрыл соединение в очереди — ожидание отменяется и место освобождается
+    runner = web.AppRunner(web_app, access_log=None, handler_cancellation=True)
+    await runner.setup()
+    await web.TCPSite(runner, WORKER_HOST, CLUSTER_SLOTS_PORT).start()
+    return runner
+
+def worker_main(index: int, workers: int, overrides: dict) -> None:
+    """Точка входа процесса-воркера (multiprocessing, spawn)."""
+    # Ctrl+C в терминале получает вся группа процессов; воркер останавливает
+    # фронт (SIGTERM) — после того, как отдал ему все принятые апдейты
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    globals().update(overrides)
+    setup_logging()
+    asyncio.run(run_worker(index, workers))
+
+async def run_worker(index: int, workers: int) -> None:
+    """Воркер: принимает от фронта пачки сырых апдейтов своих пользователей и
+    обрабатывает их обычным Application. Состояние — в общей базе, поэтому
+    при другом числе воркеров пользователи просто читаются с диска новым
+    владельцем."""
+    global METRICS_PORT
+    if METRICS_PORT is not None:
+        METRICS_PORT += 1 + index
+    if TOKENIZER_PATH:
+        set_tokenizer(load_local_tokenizer(TOKENIZER_PATH))
+    app = build_application(SQLitePersistence(STATE_DB_PATH), polling=False, workers=workers)
+    # очередь к модели одна на все воркеры — у фронта, слоты не умножаются на их число
+    schedulers = []
+    for route in app.bot_data["lm_router"].models:
+        route.scheduler = RemoteScheduler(slots_url(), route.name, route.scheduler.max_concurrent)
+        schedulers.append(route.scheduler)
+
+    async def receive(request: web.Request) -> web.Response:
+        for data in await request.json():
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        return web.Response()
+
+    web_app = web.Application(client_max_size=16 * 1024 * 1024)
+    web_app.router.add_post("/updates", receive)
+    runner = web.AppRunner(web_app, access_log=None)
+    stop = stop_event(signal.SIGTERM)
+    async with running_application(app):
+        await runner.setup()
+        await web.TCPSite(runner, WORKER_HOST, WORKER_BASE_PORT + index).start()
+        logger.info("Воркер %s/%s: %s", index, workers, worker_url(index))
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()  # новые апдейты не принимаем, начатые дорабатываем
+    for scheduler in schedulers:
+        await scheduler.close()
+    logger.info("Воркер %s остановлен", index)
+
+async def forward_updates(session_http: aiohttp.ClientSession, url: str, queue: "asyncio.Queue[dict]") -> None:
+    """Отдаёт апдейты воркеру пачками строго по порядку; пока воркер не
+    отвечает (запускается, перезапускается), пачка ждёт."""
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < WORKER_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        while True:
+            try:
+                async with session_http.post(url, json=batch) as resp:
+                    resp.raise_for_status()
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                logger.debug("Воркер %s недоступен, повтор", url, exc_info=True)
+                await asyncio.sleep(WORKER_RETRY_DELAY)
+        for _ in batch:
+            queue.task_done()
+
+class UpdatePoller:
+    """getUpdates без PTB: апдейты нужны фронту только сырыми. Offset
+    подтверждается следующим запросом, последний — в confirm()."""
+
+    def __init__(self, session_http: aiohttp.ClientSession):
+        self.session_http = session_http
+        self.api = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}"
+        self.offset = 0
+
+    async def call(self, method: str, params: dict, timeout: float = 30) -> list:
+        async with self.session_http.post(
+            f"{self.api}/{method}", json=params, timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as resp:
+            body = await resp.json()
+        if not body.get("ok"):
+            raise aiohttp.ClientError(f"{method}: {body.get('description')}")
+        return body["result"]
+
+    async def run(self, deliver: Callable[[dict], Awaitable]) -> None:
+        while True:
+            try:
+                await self.call("deleteWebhook", {})
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                logger.warning("deleteWebhook не удался", exc_info=True)
+                await asyncio.sleep(WORKER_RETRY_DELAY)
+        while True:
+            try:
+                updates = await self.call(
+                    "getUpdates", {"offset": self.offset, "timeout": POLL_TIMEOUT}, timeout=POLL_TIMEOUT + 10
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                logger.warning("getUpdates не удался", exc_info=True)
+                await asyncio.sleep(WORKER_RETRY_DELAY)
+                continue
+            for data in updates:
+                self.offset = data["update_id"] + 1
+                await deliver(data)
+
+    async def confirm(self) -> None:
+        if self.offset:
+            try:
+                await self.call("getUpdates", {"offset": self.offset, "timeout": 0})
+            except Exception:
+                logger.warning("Не удалось подтвердить последние апдейты", exc_info=True)
+
+async def run_cluster(workers: int, overrides: Optional[dict] = None, stop: Optional[asyncio.Event] = None) -> None:
+    """Фронт: принимает апдейты (polling или webhook) и по user_id раздаёт их
+    workers процессам. Остановка (SIGINT/SIGTERM или stop): приём
+    прекращается, принятое отдаётся воркерам, воркеры дорабатывают и
+    сбрасывают состояние на диск. overrides — значения конфига для воркеров.
+    Очереди к моделям — здесь же, воркеры берут слоты у фронта."""
+    slots_runner = await start_slot_server(ModelRouter(LM_MODELS))
+    ctx = multiprocessing.get_context("spawn")
+    procs: List[multiprocessing.Process] = []
+
+    def spawn(i: int) -> multiprocessing.Process:
+        proc = ctx.Process(target=worker_main, args=(i, workers, overrides or {}), name=f"bot-worker-{i}")
+        proc.start()
+        return proc
+
+    procs = [spawn(i) for i in range(workers)]
+    queues: List[asyncio.Queue] = [asyncio.Queue() for _ in range(workers)]
+
+    async def deliver(data: dict) -> None:
+        queues[shard_for(update_user_id(data), workers)].put_nowait(data)
+
+    if stop is None:
+        stop = stop_event(signal.SIGINT, signal.SIGTERM)
+    session_http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=LM_TIMEOUT))
+    senders = [asyncio.create_task(forward_updates(session_http, worker_url(i), q)) for i, q in enumerate(queues)]
+    poller: Optional[UpdatePoller] = None
+    poll_task: Optional[asyncio.Task] = None
+    webhook_runner: Optional[web.AppRunner] = None
+    try:
+        if WEBHOOK_URL:
+            webhook_runner = await start_webhook_server(deliver)
+            await UpdatePoller(session_http).call("setWebhook", {
+                k: v for k, v in (
+                    ("url", WEBHOOK_URL),
+                    ("secret_token", WEBHOOK_SECRET),
+                    ("max_connections", WEBHOOK_MAX_CONNECTIONS),
+                ) if v is not None
+            })
+        else:
+            poller = UpdatePoller(session_http)
+            poll_task = asyncio.create_task(poller.run(deliver))
+        logger.info("Фронт: %s воркеров", workers)
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+            if poll_task is not None and poll_task.done():
+                poll_task.result()  # приём апдейтов упал — фронт останавливается, а не молчит
+            for i, proc in enumerate(procs):
+                if not proc.is_alive() and not stop.is_set():
+                    logger.warning("Воркер %s завершился (код %s), перезапускаем", i, proc.exitcode)
+                    procs[i] = spawn(i)
+    finally:
+        logger.info("Остановка: дорабатываем принятые апдейты")
+        if poll_task is not None:
+            poll_task.cancel()
+            await asyncio.gather(poll_task, return_exceptions=True)
+            await poller.confirm()
+        if webhook_runner is not None:
+            await webhook_runner.cleanup()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in queues)), WORKER_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Не все апдейты переданы воркерам за %s с", WORKER_DRAIN_TIMEOUT)
+        for task in senders:
+            task.cancel()
+        await session_http.close()
+        for proc in procs:
+            proc.terminate()  # SIGTERM: воркер дорабатывает начатое
+        loop = asyncio.get_running_loop()
+        for proc in procs:
+            await loop.run_in_executor(None, proc.join, WORKER_DRAIN_TIMEOUT)
+            if proc.is_alive():
+                logger.error("Воркер %s не остановился за %s с", proc.name, WORKER_DRAIN_TIMEOUT)
+                proc.kill()
+        await slots_runner.cleanup()  # воркеры дорабатывали с этими слотами
 
+
+# ======== ЗАПУСК ========
+
+def setup_application(app) -> None:
+    """Общее состояние и хендлеры бота (им же пользуется bench.py)."""
     app.bot_data["lm_session"] = None
+    app.bot_data["lm_router"] = ModelRouter(LM_MODELS)
+    app.bot_data["lm_compactions"] = {}
+    app.bot_data["lm_cache"] = CompletionCache(db_path=CACHE_DB_PATH) if CACHE_ENABLED else None
+    app.bot_data["lm_turns"] = turns = TurnTracker()
+    if isinstance(app.update_processor, PerUserUpdateProcessor):
+        app.update_processor.turns = turns
+    app.post_init = on_startup
+    app.post_stop = on_stop
     app.post_shutdown = on_shutdown
 
     app.add_handler(CommandHandler("start", start))
@@ -538,12 +3995,57 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler("donate", donate))
     app.add_handler(CommandHandler("settemp", set_temperature))
     app.add_handler(CommandHandler("setmax", set_max_tokens))
+    app.add_handler(CommandHandler("model", set_model))
     app.add_handler(CommandHandler("reset", reset))
     app.add_handler(CommandHandler("renamechat", rename_chat))
     app.add_handler(CommandHandler("deletechat", delete_chat))
+    app.add_handler(CommandHandler("search", search_chats))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(MessageHandler(~filters.TEXT, unknown))
 
-    logger.info("Бот запущен и готов к работе!")
-    app.run_polling()
+def build_application(persistence: BasePersistence, polling: bool = True, workers: int = 1):
+    """workers — сколько процессов делят один бот: общий лимит Bot API и
+    лимит групп (в группе пишут пользователи разных воркеров) делятся поровну."""
+    builder = ApplicationBuilder() \
+        .token(TELEGRAM_BOT_TOKEN) \
+        .base_url(f"{TELEGRAM_API_URL}/bot") \
+        .request(InstrumentedRequest(connection_pool_size=TG_CONNECTION_POOL_SIZE)) \
+        .persistence(persistence) \
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    if TG_RATE_LIMIT:
+        builder = builder.rate_limiter(
+            OutboundRateLimiter(TG_GLOBAL_RATE / workers, TG_CHAT_RATE, TG_CHAT_BURST, TG_GROUP_RATE / workers)
+        )
+    if not polling:
+        builder = builder.updater(None)
+    app = builder.build()
+    setup_application(app)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CassielGPT — Telegram-бот для LM Studio")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="число процессов-воркеров (0 — всё в одном процессе)")
+    args = parser.parse_args()
+    setup_logging()
+
+    if os.path.exists(LEGACY_PICKLE_PATH) and not os.path.exists(STATE_DB_PATH):
+        n = migrate_pickle_state(LEGACY_PICKLE_PATH, STATE_DB_PATH)
+        os.replace(LEGACY_PICKLE_PATH, LEGACY_PICKLE_PATH + ".migrated")
+        logger.info("Перенесено пользователей из %s: %s", LEGACY_PICKLE_PATH, n)
+
+    if args.workers > 0:
+        logger.info("Бот запущен: фронт и %s воркеров", args.workers)
+        asyncio.run(run_cluster(args.workers))
+    else:
+        if TOKENIZER_PATH:
+            set_tokenizer(load_local_tokenizer(TOKENIZER_PATH))
+
+        app = build_application(SQLitePersistence(STATE_DB_PATH))
+
+        logger.info("Бот запущен и готов к работе!")
+        if WEBHOOK_URL:
+            asyncio.run(run_webhook(app))
+        else:
+            app.run_polling()
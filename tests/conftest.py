@@ -0,0 +1,134 @@
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import pytest
+from aiohttp import web
+from telegram import Update
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API без сети: записывает вызовы (метод, параметры) и правдоподобно
+    отвечает. fail[метод] — очередь ответов-ошибок (код, описание, retry_after)
+    на ближайшие вызовы этого метода. messages — что сейчас видно в чатах:
+    message_id -> параметры последней отправки/правки."""
+
+    def __init__(self):
+        self.calls: List[Tuple[str, dict]] = []
+        self.fail: Dict[str, list] = defaultdict(list)
+        self.messages: Dict[int, dict] = {}
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def count(self, method: str) -> int:
+        return Counter(name for name, _ in self.calls)[method]
+
+    def params(self, method: str) -> List[dict]:
+        return [p for name, p in self.calls if name == method]
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        name = url.rsplit("/", 1)[1]
+        params = {}
+        for k, v in (request_data.parameters if request_data else {}).items():
+            try:
+                params[k] = json.loads(v) if isinstance(v, str) else v
+            except ValueError:
+                params[k] = v
+        self.calls.append((name, params))
+        if self.fail[name]:
+            code, description, retry_after = self.fail[name].pop(0)
+            body = {"ok": False, "error_code": code, "description": description}
+            if retry_after is not None:
+                body["parameters"] = {"retry_after": retry_after}
+            return code, json.dumps(body).encode()
+        result: object = True
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        elif name in ("sendMessage", "editMessageText"):
+            message_id = params.get("message_id") or next(self._message_ids)
+            self.messages[message_id] = params
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif name == "deleteMessage":
+            self.messages.pop(params["message_id"], None)
+        elif name == "deleteMessages":
+            for message_id in params["message_ids"]:
+                self.messages.pop(message_id, None)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class Telegram:
+    def __init__(self):
+        self.request = FakeTelegram()
+        self._update_ids = itertools.count(1)
+
+    def bot(self, rate_limiter=None) -> ExtBot:
+        return ExtBot("0:test", request=self.request, get_updates_request=FakeTelegram(), rate_limiter=rate_limiter)
+
+    def update(self, ext_bot: ExtBot, user_id: int, text: str) -> Update:
+        n = next(self._update_ids)
+        return Update.de_json({"update_id": n, "message": {
+            "message_id": n,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        }}, ext_bot)
+
+
+@pytest.fixture
+def tg() -> Telegram:
+    return Telegram()
+
+
+@asynccontextmanager
+async def serve_lm(handler):
+    """Заглушка LM Studio на свободном порту: handler(request) отвечает на
+    /v1/chat/completions и /v1/models. Отдаёт url для LM_MODELS."""
+    async def handle(request):
+        return await handler(request)
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}/v1/chat/completions"
+    finally:
+        await runner.cleanup()
+
+
+def completion(content: str) -> web.Response:
+    return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+
+@pytest.fixture
+def lm():
+    return SimpleNamespace(serve=serve_lm, completion=completion)
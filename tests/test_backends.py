@@ -0,0 +1,117 @@
+import asyncio
+import socket
+import time
+
+import aiohttp
+import pytest
+
+import bot
+
+PAYLOAD = {"model": "m", "messages": [{"role": "user", "content": "привет"}]}
+
+
+def dead_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}/v1/chat/completions"
+
+
+class Backend:
+    """Заглушка бэкенда: на запросы отвечает status (200 — ответом модели) и считает их."""
+
+    def __init__(self, lm, status: int = 200):
+        self.lm = lm
+        self.status = status
+        self.hits = 0
+
+    async def __call__(self, request):
+        if request.path.endswith("/models"):
+            return self.lm.completion("") if self.status == 200 else aiohttp.web.Response(status=self.status)
+        self.hits += 1
+        if self.status != 200:
+            return aiohttp.web.Response(status=self.status, text="ошибка")
+        return self.lm.completion("ответ")
+
+
+def test_failover_to_healthy_backend_and_breaker(lm):
+    bad, good = Backend(lm, 500), Backend(lm)
+
+    async def main():
+        async with lm.serve(bad) as bad_url, lm.serve(good) as good_url, aiohttp.ClientSession() as http:
+            pool = bot.BackendPool([{"url": bad_url, "model": "m"}, {"url": good_url, "model": "m"}])
+            replies = [await bot.fetch_completion(http, pool, PAYLOAD) for _ in range(bot.LM_BREAKER_FAILURES + 2)]
+            broken = not pool.backends[0].available(time.monotonic())
+            # бэкенд поднялся — проверка /v1/models возвращает его в ротацию
+            bad.status = 200
+            await pool._probe(http, pool.backends[0])
+            return replies, broken, pool.backends[0].available(time.monotonic())
+
+    replies, broken, back = asyncio.run(main())
+    assert replies == ["ответ"] * (bot.LM_BREAKER_FAILURES + 2)
+    assert bad.hits == bot.LM_BREAKER_FAILURES  # после этого выведен из ротации
+    assert broken and back
+
+
+def test_failover_from_unreachable_backend(lm):
+    good = Backend(lm)
+
+    async def main():
+        async with lm.serve(good) as good_url, aiohttp.ClientSession() as http:
+            pool = bot.BackendPool([{"url": dead_url(), "model": "m"}, {"url": good_url, "model": "m"}])
+            return await bot.fetch_completion(http, pool, PAYLOAD), pool.backends[0].failures
+
+    assert asyncio.run(main()) == ("ответ", 1)
+
+
+def test_client_error_is_not_retried(lm):
+    first, second = Backend(lm, 400), Backend(lm)
+
+    async def main():
+        async with lm.serve(first) as u1, lm.serve(second) as u2, aiohttp.ClientSession() as http:
+            pool = bot.BackendPool([{"url": u1, "model": "m"}, {"url": u2, "model": "m"}])
+            with pytest.raises(bot.LMError):
+                await bot.fetch_completion(http, pool, PAYLOAD)
+            return pool.backends[0].failures
+
+    assert asyncio.run(main()) == 0  # ошибка в запросе, бэкенд жив
+    assert second.hits == 0
+
+
+def test_fair_scheduler_serves_users_round_robin():
+    async def main():
+        scheduler = bot.FairScheduler(max_concurrent=1, max_queue=100)
+        order = []
+
+        async def turn(user_id):
+            async with scheduler.slot(user_id):
+                order.append(user_id)
+                await asyncio.sleep(0)
+
+        await scheduler.acquire(0)  # слот занят, дальше все в очередь
+        tasks = [asyncio.create_task(turn(1)) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(turn(u)) for u in (2, 3, 2)]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order, scheduler
+
+    order, scheduler = asyncio.run(main())
+    # тот, кто насыпал запросов первым, не обгоняет остальных
+    assert order == [1, 2, 3, 1, 2, 1, 1, 1, 1]
+    assert (scheduler.active, scheduler.waiting) == (0, 0)
+
+
+def test_fair_scheduler_rejects_over_max_queue():
+    async def main():
+        scheduler = bot.FairScheduler(max_concurrent=1, max_queue=1)
+        await scheduler.acquire(1)
+        waiter = asyncio.create_task(scheduler.acquire(1))
+        await asyncio.sleep(0)
+        with pytest.raises(bot.LMBusy):
+            await scheduler.acquire(2)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return scheduler.waiting, scheduler.rejected
+
+    assert asyncio.run(main()) == (0, 1)
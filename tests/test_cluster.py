@@ -0,0 +1,49 @@
+import asyncio
+import socket
+
+import bot
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_workers_share_front_slots(monkeypatch):
+    monkeypatch.setattr(bot, "CLUSTER_SLOTS_PORT", free_port())
+
+    async def main():
+        router = bot.ModelRouter([{"name": "m", "backends": [{"url": "http://x", "model": "m"}],
+                                   "max_concurrent": 2, "max_queue": 10}])
+        runner = await bot.start_slot_server(router)
+        # больше воркеров, чем слотов
+        workers = [bot.RemoteScheduler(bot.slots_url(), "m", 2) for _ in range(4)]
+        running = peak = 0
+
+        async def turn(scheduler, user_id):
+            nonlocal running, peak
+            async with scheduler.slot(user_id):
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.02)
+                running -= 1
+
+        try:
+            await asyncio.gather(*(turn(w, uid) for uid, w in enumerate(workers * 3)))
+            # ушедший из очереди воркер не держит слот
+            waiter = asyncio.create_task(turn(workers[0], 100))
+            async with workers[1].slot(1), workers[2].slot(2):
+                await asyncio.sleep(0.05)
+                waiter.cancel()
+                await asyncio.gather(waiter, return_exceptions=True)
+            await asyncio.wait_for(turn(workers[3], 3), 1)
+        finally:
+            for w in workers:
+                await w.close()
+            await runner.cleanup()
+        return peak, router.models[0].scheduler
+
+    peak, scheduler = asyncio.run(main())
+    assert peak == 2
+    assert (scheduler.active, scheduler.waiting) == (0, 0)
@@ -0,0 +1,73 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+
+import bot
+
+
+def chat(n: int) -> bot.ChatSession:
+    session = bot.ChatSession("чат")
+    for i in range(n):
+        bot.append_history(session, bot.Role.USER, f"вопрос {i}")
+        bot.append_history(session, bot.Role.ASSISTANT, f"ответ {i}")
+    return session
+
+
+class App:
+    def __init__(self):
+        self.bot_data = {"lm_compactions": {}}
+        self.marked = []
+
+    def mark_data_for_update_persistence(self, user_ids=None, chat_ids=None):
+        self.marked.extend(user_ids or ())
+
+
+def test_compaction_merges_into_history_that_moved_on(lm):
+    session = chat(10)
+    slab_start, slab_end = bot.compaction_slab(session.history)
+    release = asyncio.Event()
+
+    async def handler(request):
+        await release.wait()
+        return lm.completion("краткое содержание")
+
+    async def main():
+        async with lm.serve(handler) as url, aiohttp.ClientSession() as http:
+            router = bot.ModelRouter([{"name": "m", "backends": [{"url": url, "model": "m"}]}])
+            app = App()
+            bot.start_compaction(app, http, router, 1, session)
+            await asyncio.sleep(0.05)
+            # пользователь пишет дальше, пока модель сворачивает
+            bot.append_history(session, bot.Role.USER, "новый вопрос")
+            bot.append_history(session, bot.Role.ASSISTANT, "новый ответ")
+            release.set()
+            await asyncio.wait_for(asyncio.gather(*app.bot_data["lm_compactions"].values()), 5)
+            return app
+
+    system = session.history[0].content
+    kept = [m.content for m in session.history[slab_end:]] + ["новый вопрос", "новый ответ"]
+    app = asyncio.run(main())
+    assert session.summary == "краткое содержание"
+    assert [m.content for m in session.history] == [system] + kept
+    assert session.history_tokens == sum(bot.message_tokens(m) for m in session.history)
+    assert app.marked == [1]
+    assert slab_start == 1
+
+
+def test_compaction_dropped_when_chat_was_reset(lm):
+    session = chat(10)
+
+    async def handler(request):
+        session.history = session.history[:1]  # /reset, пока модель думала
+        session.history_tokens = None
+        return lm.completion("краткое содержание")
+
+    async def main():
+        async with lm.serve(handler) as url, aiohttp.ClientSession() as http:
+            router = bot.ModelRouter([{"name": "m", "backends": [{"url": url, "model": "m"}]}])
+            return await bot.compact_history(http, router, 1, session)
+
+    assert asyncio.run(main()) is False
+    assert session.summary is None
+    assert len(session.history) == 1
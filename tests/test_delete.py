@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture(autouse=True)
+def no_flood_wait(monkeypatch):
+    # сколько ждать, решает Telegram; в тестах не ждём
+    monkeypatch.setattr(bot, "_retry_after_seconds", lambda e: 0.0)
+
+
+def delete(tg, ids, rate_limiter=None):
+    async def run():
+        ext = tg.bot(rate_limiter=rate_limiter)
+        await ext.initialize()
+        try:
+            return await bot.delete_messages_bulk(ext, 1, ids)
+        finally:
+            await ext.shutdown()
+
+    return asyncio.run(run())
+
+
+def test_flood_wait_retries_batch_instead_of_single_deletes(tg):
+    tg.request.fail["deleteMessages"] = [(429, "Too Many Requests: retry after 1", 1)] * 2
+    assert delete(tg, list(range(1, 151))) == []
+    assert tg.request.count("deleteMessages") == 2 + 2  # две пачки, одна дважды выждала
+    assert tg.request.count("deleteMessage") == 0
+
+
+def test_rejected_batch_falls_back_to_single_deletes(tg):
+    tg.request.fail["deleteMessages"] = [(400, "Bad Request: message can't be deleted", None)]
+    tg.request.fail["deleteMessage"] = [
+        (429, "Too Many Requests: retry after 1", 1),
+        (400, "Bad Request: message to delete not found", None),
+    ]
+    assert delete(tg, [1, 2, 3]) == [1]
+    assert tg.request.count("deleteMessage") == 4
+
+
+def test_flood_wait_with_rate_limiter(tg, monkeypatch):
+    monkeypatch.setattr(bot, "TG_FLOOD_RETRIES", 1)
+    limiter = bot.OutboundRateLimiter(1000.0, 1000.0, 1000, 1000.0)
+    tg.request.fail["deleteMessages"] = [(429, "Too Many Requests: retry after 1", 1)] * 3
+    assert delete(tg, [1, 2], rate_limiter=limiter) == []
+    assert tg.request.count("deleteMessages") == 4
+    assert tg.request.count("deleteMessage") == 0
@@ -0,0 +1,41 @@
+import re
+
+import pytest
+
+import bot
+
+LONG_BOLD = "Вступление. " * 20 + "**" + "жирный текст без конца " * 30 + "** хвост."
+LONG_CODE = "Код:\n```\n" + "\n".join(f"    line {i} = {i} * 2" for i in range(200)) + "\n```\nконец"
+MIXED = "\n\n".join(f"Абзац {i} с `кодом {i}` и *курсивом* и [ссылкой](https://x.test/{i})." for i in range(60))
+
+
+def visible(text: str) -> str:
+    return re.sub(r"\s+", "", text)
+
+
+@pytest.mark.parametrize("text", [LONG_BOLD, LONG_CODE, MIXED])
+@pytest.mark.parametrize("limit", [100, 333, 4096])
+def test_chunk_runs_invariants(text, limit):
+    runs = bot.parse_markdown(text)
+    chunks = bot.chunk_runs(runs, limit)
+    for chunk in chunks:
+        assert sum(len(t) for t, _ in chunk) <= limit
+        html = bot.runs_to_html(chunk)
+        opened = re.findall(r"<(b|i|code|pre|a)[ >]", html)
+        closed = re.findall(r"</(b|i|code|pre|a)>", html)
+        assert sorted(opened) == sorted(closed)
+    # режется только по пробелам: видимый текст целиком сохраняется
+    assert visible("".join(t for c in chunks for t, _ in c)) == visible("".join(t for t, _ in runs))
+
+
+def test_entity_that_fits_is_not_split():
+    text = "а " * 40 + "**" + "б " * 19 + "б**"
+    chunks = bot.render_chunks(text, 100)
+    assert any(html.startswith("<b>") and html.endswith("</b>") for html, _ in chunks)
+    assert all(html.count("<b>") == html.count("</b>") for html, _ in chunks)
+
+
+def test_code_chunk_keeps_leading_indentation():
+    chunks = bot.render_chunks(LONG_CODE, 200)
+    code = [plain for html, plain in chunks[1:] if html.startswith("<pre>")]
+    assert code and all(plain.startswith("    line") for plain in code)
@@ -0,0 +1,124 @@
+import asyncio
+from collections import Counter
+from copy import deepcopy
+
+import bot
+
+
+def recording(persistence) -> Counter:
+    """Сколько строк прошло через каждый SQL при записях persistence."""
+    rows: Counter = Counter()
+    write = persistence._write
+
+    def _write(ops):
+        for sql, batch in ops:
+            rows[sql] += len(batch)
+        write(ops)
+
+    persistence._write = _write
+    return rows
+
+
+async def flush(persistence, user_id: int, data: dict) -> None:
+    # как Application.update_persistence: в хранилище уходит deepcopy
+    await persistence.update_user_data(user_id, deepcopy(data))
+    if persistence._commit_task is not None:
+        await persistence._commit_task
+
+
+def say(chat: bot.ChatSession, n: int) -> None:
+    bot.append_history(chat, bot.Role.USER, f"Вопрос про отчёт номер {n}")
+    bot.append_history(chat, bot.Role.ASSISTANT, f"Ответ номер {n}")
+
+
+def stored(persistence, user_id: int) -> list:
+    conn = persistence._db()
+    return [tuple(r) for r in conn.execute(
+        "SELECT role, content FROM messages WHERE user_id = ? ORDER BY seq", (user_id,)
+    )]
+
+
+def test_flush_writes_only_new_messages(tmp_path):
+    async def main():
+        persistence = bot.SQLitePersistence(str(tmp_path / "state.sqlite3"))
+        rows = recording(persistence)
+        data: dict = {}
+        await persistence.refresh_user_data(1, data)
+        chat = bot.ChatSession("чат 1")
+        data.update({"chats": {"c1": chat}, "active_chat": "c1", "temperature": 0.7})
+        for n in range(10):
+            say(chat, n)
+        await flush(persistence, 1, data)
+        assert rows[bot._INSERT_MESSAGES] == 21
+
+        rows.clear()
+        say(chat, 10)
+        await flush(persistence, 1, data)
+        assert rows[bot._INSERT_MESSAGES] == 2
+        assert rows[bot._DELETE_MESSAGES] == 0
+        assert rows[bot._DELETE_CHAT_TERMS] == 0
+
+        rows.clear()
+        await flush(persistence, 1, data)
+        assert sum(rows.values()) == 0
+
+        # trim_history_for_budget выкинул самые старые реплики
+        rows.clear()
+        del chat.history[1:5]
+        chat.history_tokens = None
+        say(chat, 11)
+        await flush(persistence, 1, data)
+        assert rows[bot._DELETE_MESSAGE] == 4
+        assert rows[bot._INSERT_MESSAGES] == 2
+        assert stored(persistence, 1) == [(m.role.value, m.content) for m in chat.history]
+        await persistence.flush()
+
+    asyncio.run(main())
+
+
+def test_reset_rewrites_chat(tmp_path):
+    async def main():
+        persistence = bot.SQLitePersistence(str(tmp_path / "state.sqlite3"))
+        data: dict = {}
+        await persistence.refresh_user_data(1, data)
+        chat = bot.ChatSession("чат 1")
+        data.update({"chats": {"c1": chat}, "active_chat": "c1"})
+        say(chat, 0)
+        await flush(persistence, 1, data)
+        bot.reset_history(chat)
+        say(chat, 1)
+        await flush(persistence, 1, data)
+        assert stored(persistence, 1) == [(m.role.value, m.content) for m in chat.history]
+        await persistence.flush()
+
+    asyncio.run(main())
+
+
+def test_collect_idle_after_flush_does_not_rewrite(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "CHAT_PAGE_OUT_IDLE", 0)
+    monkeypatch.setattr(bot, "USER_EVICT_IDLE", 0)
+    monkeypatch.setattr(bot, "USER_STATE_MEMORY_LIMIT", 0)
+
+    async def main():
+        persistence = bot.SQLitePersistence(str(tmp_path / "state.sqlite3"))
+        rows = recording(persistence)
+        data: dict = {}
+        await persistence.refresh_user_data(1, data)
+        chats = {f"c{i}": bot.ChatSession(f"чат {i}") for i in range(3)}
+        data.update({"chats": chats, "active_chat": "c0"})
+        for n, chat in enumerate(chats.values()):
+            say(chat, n)
+        await flush(persistence, 1, data)
+
+        rows.clear()
+        dropped = []
+        app = type("App", (), {"user_data": {1: data}, "drop_user_data": lambda self, uid: dropped.append(uid)})()
+        paged, evicted = persistence.collect_idle(app)
+        if persistence._commit_task is not None:
+            await persistence._commit_task
+        assert (paged, evicted) == (2, 1)
+        assert dropped == [1]
+        assert sum(rows.values()) == 0
+        await persistence.flush()
+
+    asyncio.run(main())
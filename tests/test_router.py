@@ -0,0 +1,45 @@
+import bot
+
+FAST = {"name": "fast", "backends": [{"url": "http://fast", "model": "fast"}],
+        "max_prompt_tokens": 1500, "max_completion_tokens": 512}
+BIG = {"name": "big", "backends": [{"url": "http://big", "model": "big"}]}
+
+
+def test_short_prompt_goes_to_fast_model_and_is_clamped():
+    router = bot.ModelRouter([FAST, BIG])
+    route = router.choose(100)
+    assert route.name == "fast"
+    assert route.clamp(1024) == 512
+
+
+def test_long_prompt_goes_to_big_model():
+    router = bot.ModelRouter([FAST, BIG])
+    assert router.choose(5000).name == "big"
+
+
+def test_requested_max_tokens_prefers_model_that_fits():
+    router = bot.ModelRouter([FAST, BIG])
+    assert router.choose(100, 2000).name == "big"
+    assert router.choose(100, 256).name == "fast"
+    # закреплённая пользователем модель важнее
+    assert router.choose(100, 2000, "fast").name == "fast"
+
+
+def test_unmeasured_model_is_not_preferred_over_measured():
+    router = bot.ModelRouter([FAST, BIG])
+    fast, big = router.models
+    big.latency = 1.0
+    assert router.choose(100).name == "fast"  # обе «по 1 с» — первая в списке
+    fast.latency = 3.0
+    assert router.choose(100).name == "big"
+    big.latency = None
+    assert router.choose(100).name == "fast"
+
+
+def test_queue_depth_counts_in_expected_wait():
+    router = bot.ModelRouter([FAST, BIG])
+    fast, big = router.models
+    fast.latency, big.latency = 1.0, 2.0
+    assert router.choose(100).name == "fast"
+    fast.scheduler.waiting = 4  # ждут очереди к быстрой модели
+    assert router.choose(100).name == "big"
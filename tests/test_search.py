@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+import bot
+
+WORD_FORMS = [
+    ["отчёт", "отчёты", "отчёта", "отчётов", "отчёту", "отчётом", "отчёте", "отчётами", "отчет"],
+    ["ответ", "ответы", "ответа", "ответов", "ответу", "ответом", "ответе", "ответам"],
+    ["билет", "билеты", "билета", "билетов", "билету", "билетом", "билете"],
+    ["привет", "приветы", "привета", "приветов", "привету", "приветом", "привете"],
+    ["чат", "чаты", "чата", "чатов", "чату", "чатом", "чате", "чатами"],
+    ["книга", "книги", "книгу", "книгой", "книге", "книгами", "книгах"],
+    ["сообщение", "сообщения", "сообщений", "сообщением", "сообщениями"],
+]
+
+
+@pytest.mark.parametrize("forms", WORD_FORMS, ids=[f[0] for f in WORD_FORMS])
+def test_word_forms_share_search_term(forms):
+    assert len({bot.search_term(w) for w in forms}) == 1
+
+
+def test_search_finds_other_word_form(tmp_path):
+    async def main():
+        persistence = bot.SQLitePersistence(str(tmp_path / "state.sqlite3"))
+        data: dict = {}
+        await persistence.refresh_user_data(1, data)
+        chat = bot.ChatSession("чат 1")
+        bot.append_history(chat, bot.Role.USER, "Где квартальный отчёт?")
+        data.update({"chats": {"c1": chat}, "active_chat": "c1"})
+        terms = bot.search_terms("отчёты")
+        found = await persistence.search(1, data, terms)
+        await persistence.flush()
+        return found
+
+    found = asyncio.run(main())
+    assert [chat_id for chat_id, *_ in found] == ["c1"]
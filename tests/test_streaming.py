@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+async def stream(tg, limiter, words: int = 12, pause: float = 0.03) -> str:
+    ext = tg.bot(rate_limiter=limiter)
+    await ext.initialize()
+    try:
+        out = bot.StreamingReply(tg.update(ext, 1, "вопрос"), SimpleNamespace(bot=ext))
+        text = ""
+        for i in range(words):
+            text += f"слово{i} "
+            out.push("", text)
+            await asyncio.sleep(pause)
+        await out.finish(text.strip())
+        return text.strip()
+    finally:
+        await ext.shutdown()
+
+
+def test_stream_edits_pass_through_rate_limiter(tg, monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.01)
+    limiter = bot.OutboundRateLimiter(1000.0, 1000.0, 1000, 1000.0)
+    final = asyncio.run(stream(tg, limiter))
+    edits = tg.request.params("editMessageText")
+    assert tg.request.count("sendMessage") == 1
+    assert len(edits) >= 5  # промежуточные правки не падают на rate_limit_args
+    assert edits[-1]["text"] == final
+
+
+def test_busy_chat_skips_intermediate_edits_but_not_final(tg, monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.0)
+    limiter = bot.OutboundRateLimiter(1000.0, 2.0, 1, 1.0)
+    final = asyncio.run(stream(tg, limiter, words=20, pause=0.01))
+    edits = tg.request.params("editMessageText")
+    assert len(edits) < 20
+    assert edits[-1]["text"] == final
+
+
+MARKDOWN_REPLY = "\n".join(
+    [f"Пункт {i}: **важное замечание номер {i}, которое тянется довольно долго**." for i in range(8)]
+    + ["```python", *[f"    if x == {i}:\n        return {i}" for i in range(12)], "```", "Итог: `готово`."]
+)
+
+
+def test_streamed_final_is_chunked_like_send_long_text(tg, monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.0)
+    monkeypatch.setattr(bot, "TG_TEXT_LIMIT", 300)
+
+    async def run():
+        ext = tg.bot()
+        await ext.initialize()
+        try:
+            out = bot.StreamingReply(tg.update(ext, 1, "вопрос"), SimpleNamespace(bot=ext))
+            for end in range(40, len(MARKDOWN_REPLY) + 40, 40):
+                text = MARKDOWN_REPLY[:end]
+                out.push(text[:text.rfind("\n") + 1], text)
+                await asyncio.sleep(0.005)
+            await out.finish(MARKDOWN_REPLY)
+        finally:
+            await ext.shutdown()
+
+    asyncio.run(run())
+    shown = [(p["text"], p.get("parse_mode")) for _, p in sorted(tg.request.messages.items())]
+    assert shown == [(h, "HTML") for h, _ in bot.render_chunks(MARKDOWN_REPLY, 300)]
+    assert len(shown) > 2